@@ -7,8 +7,13 @@ JSON API definition.
 
 
 class Page(object):
-    def __init__(self, item_count, page_index=1, page_size=10):
+    def __init__(self, item_count, page_index=1, page_size=10, approximate=False):
+        """
+        :param item_count: total number of items, may come from Model.count_rows(cached=True)
+        :param approximate: True if item_count is an estimate
+        """
         self.item_count = item_count
+        self.approximate = approximate
         self.page_size = page_size
         self.page_count = self.item_count // self.page_size + (0 if self.item_count % self.page_size == 0 else 1)
         if item_count == 0 or (page_index > self.page_count):
@@ -11,7 +11,8 @@ from jinja2 import Environment, FileSystemLoader
 
 import orm
 from async_web_framework import add_routes, add_static
-from factorys_and_filters import logger_factory, data_factory, response_factory, datetime_filter, auth_factory
+from factorys_and_filters import logger_factory, query_stats_factory, data_factory, response_factory, datetime_filter, \
+    auth_factory
 
 
 def init_jinja2(application, **kwargs):
@@ -45,11 +46,12 @@ def init_app(event_loop, host='127.0.0.1', port=8000):
         loop=loop,
         user='blog-data',
         password=' ',
-        db='blog')
+        db='blog',
+        query_cache_bytes=32 * 1024 * 1024)
 
     app = web.Application(
         loop=event_loop,
-        middlewares=[logger_factory, data_factory, auth_factory, response_factory])
+        middlewares=[logger_factory, query_stats_factory, data_factory, auth_factory, response_factory])
 
     init_jinja2(app, filters=dict(datetime=datetime_filter))
 
@@ -67,4 +69,10 @@ def init_app(event_loop, host='127.0.0.1', port=8000):
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     loop.run_until_complete(init_app(loop))
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 关闭前把write-behind缓冲区里的行写进数据库
+        loop.run_until_complete(orm.destroy_pool())
@@ -4,7 +4,9 @@ configs = {
         'port': 3306,
         'user': 'blog-data',
         'password': ' ',
-        'database': 'blog'
+        'database': 'blog',
+        # 只读副本 e.g. [dict(host='10.0.0.2', port=3306, weight=1)], migrations.py按它们的复制延迟限速
+        'replicas': []
     },
     'session': {
         'secret': 'Design by Apple in California'
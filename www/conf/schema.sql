@@ -27,6 +27,9 @@ create table blogs (
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    `version` bigint not null default 0,
+    `content_z` mediumblob,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
@@ -39,6 +42,8 @@ create table comments (
     `user_avatar` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
@@ -10,6 +10,8 @@ import datetime
 from aiohttp import web
 from urllib import parse
 
+import orm
+from orm import CompressedText
 from handlers import cookie2user, COOKIE_NAME
 
 
@@ -22,6 +24,23 @@ def logger_factory(app, handler):
     return logger
 
 
+@asyncio.coroutine
+def query_stats_factory(app, handler):
+    @asyncio.coroutine
+    def query_stats(request):
+        # 这个请求(和它启动的task)执行的sql 同一种语句执行太多次时orm会打warning
+        with orm.track_queries(app.get('__n_plus_one__', 10)) as stats:
+            request.__queries__ = stats
+            resp = yield from handler(request)
+        logging.info('[Query Stats]: %s %s: %s queries in %.1fms' %
+                     (request.method, request.path, stats.total, stats.time * 1000))
+        if isinstance(resp, web.StreamResponse) and not resp.prepared:
+            resp.headers['X-Query-Count'] = str(stats.total)
+            resp.headers['X-Query-Time'] = '%.1f' % (stats.time * 1000)
+        return resp
+    return query_stats
+
+
 @asyncio.coroutine
 def data_factory(app, handler):
     @asyncio.coroutine
@@ -66,6 +85,16 @@ def auth_factory(app, handler):
     return auth
 
 
+def json_default(obj):
+    # orm.Row 用__slots__ 没有__dict__
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    # 还没解压的CompressedTextField值
+    if isinstance(obj, CompressedText):
+        return str(obj)
+    return obj.__dict__
+
+
 @asyncio.coroutine
 def response_factory(app, handler):
     @asyncio.coroutine
@@ -101,7 +130,7 @@ def response_factory(app, handler):
                     body=json.dumps(
                         raw_resp,
                         ensure_ascii=False,
-                        default=lambda obj: obj.__dict__).encode()
+                        default=json_default).encode()
                 )
                 resp.content_type = 'application/json; charset=utf-8'
                 return resp
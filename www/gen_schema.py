@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Print the DDL of the models
+
+    python3 gen_schema.py            CREATE TABLE statements
+    python3 gen_schema.py --indexes  CREATE INDEX statements, for adding new indexes to existing tables
+"""
+
+import sys
+
+from orm import create_table_sql, create_index_sql
+from model import User, Blog, Comment
+
+MODELS = [User, Blog, Comment]
+
+
+if __name__ == '__main__':
+    for model in MODELS:
+        if '--indexes' in sys.argv:
+            print('\n'.join(create_index_sql(model)))
+        else:
+            print(create_table_sql(model))
+            print()
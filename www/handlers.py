@@ -4,12 +4,15 @@
 import re
 import time
 import json
+import base64
 import logging
 import hashlib
 import asyncio
 from aiohttp import web
 
+import orm
 import markdown2
+from orm import StaleDataError
 
 from conf.config import configs
 from async_web_framework import get, post
@@ -67,6 +70,27 @@ def text2html(text):
     return ''.join(lines)
 
 
+def encode_cursor(direction, blog):
+    # 对客户端不透明的游标: {"after": [created_at, id]} 的 urlsafe base64
+    data = json.dumps({direction: [blog.created_at, blog.id]})
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if not isinstance(data, dict) or len(data) != 1:
+            raise ValueError('cursor must be an object with one key')
+        direction, (created_at, blog_id) = next(iter(data.items()))
+        if direction not in ('after', 'before') or not isinstance(blog_id, str):
+            raise ValueError('invalid cursor position')
+        created_at = float(created_at)
+    except (ValueError, TypeError, AttributeError):
+        # 客户端传来的任何畸形游标都是参数错误 不能变成500
+        raise APIValueError('cursor', 'invalid cursor')
+    return direction, (created_at, blog_id)
+
+
 def get_page_index(page_str):
     p = 1
     try:
@@ -82,7 +106,8 @@ def get_page_index(page_str):
 @get('/')
 @asyncio.coroutine
 def index(request):
-    blogs = yield from Blog.find_all(limit=8, order_by='created_at DESC')
+    # 首页只显示标题和简介 不读取content
+    blogs = yield from Blog.find_all(limit=8, order_by='created_at DESC', defer=['content'], as_rows=True)
     return dict(
         __template__='index.html',
         blogs=blogs,
@@ -136,10 +161,12 @@ def edit_blog(request, *, blog_id):  # 编辑存在的日志
 @get('/blog/{blog_id}')
 @asyncio.coroutine
 def read_blog(blog_id, request):
-    blog = yield from Blog.find_by_primary_key(blog_id)
+    # 两个查询互不依赖 同时查
+    blog, comments = yield from orm.gather(
+        Blog.find_by_primary_key(blog_id),
+        Comment.find_all(where='blog_id=?', args=[blog_id], order_by='created_at DESC', select_related=['user']))
     if not blog:
         raise APIResourceNotFoundError('blog', '似乎来到了没有知识的荒原')
-    comments = yield from Comment.find_all(where='blog_id=?', args=[blog_id], order_by='created_at DESC')
 
     # escape
     for c in comments:
@@ -153,6 +180,53 @@ def read_blog(blog_id, request):
     }
 
 
+# 按月归档: created_at是unix时间戳 分组和范围都在MySQL里按同一个时区换算
+_ARCHIVE_MONTHS = [('year', 'YEAR(FROM_UNIXTIME(`created_at`))'), ('month', 'MONTH(FROM_UNIXTIME(`created_at`))')]
+
+
+@asyncio.coroutine
+def archive_months():
+    """:return: BlogAggregate(year, month, count) of every month with blogs, newest first"""
+    # 只扫描idx_created_at 结果在查询缓存里 直到blogs表被修改
+    return (yield from Blog.aggregate(group_by=_ARCHIVE_MONTHS, count='*', order_by='`year` DESC, `month` DESC'))
+
+
+@get('/archive')
+@asyncio.coroutine
+def archive(request):
+    return {
+        '__template__': 'archive.html',
+        '__user__': request.__user__,
+        'months': (yield from archive_months()),
+        'current': None,
+        'blogs': []
+    }
+
+
+@get('/archive/{year}/{month}')
+@asyncio.coroutine
+def archive_month(year, month, request):
+    try:
+        year, month = int(year), int(month)
+    except ValueError:
+        raise APIResourceNotFoundError('archive', '没有这个月份')
+    if not 1 <= month <= 12 or not 1970 <= year <= 9999:
+        raise APIResourceNotFoundError('archive', '没有这个月份')
+    first_day = '%04d-%02d-01' % (year, month)
+    months, blogs = yield from orm.gather(
+        archive_months(),
+        # 常量表达式 走idx_created_at的范围扫描
+        Blog.find_all(where='`created_at` >= UNIX_TIMESTAMP(?) AND `created_at` < UNIX_TIMESTAMP(? + INTERVAL 1 MONTH)',
+                      args=[first_day, first_day], order_by='created_at DESC', defer=['content'], as_rows=True))
+    return {
+        '__template__': 'archive.html',
+        '__user__': request.__user__,
+        'months': months,
+        'current': (year, month),
+        'blogs': blogs
+    }
+
+
 # ---------------------------------- API -----------------------------------
 _RE_EMAIL = re.compile(r'^[a-z0-9.\-_]+@[a-z0-9\-_]+(\.[a-z0-9\-_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
@@ -161,21 +235,23 @@ _RE_SHA1 = re.compile(r'^[0-9a-f]{40}$')
 @post('/api/signup')
 @asyncio.coroutine
 def api_signup(*, email, name, password):
-    if not name or not name.strip():
+    # 和users表的列宽一致 超长的值不能被截断后存进去
+    if not name or not name.strip() or len(name) > 50:
         raise APIValueError('name')
-    if not email or not re.match(_RE_EMAIL, email):
+    if not email or len(email) > 50 or not re.match(_RE_EMAIL, email):
         raise APIValueError('email')
     if not password or not re.match(_RE_SHA1, password):  # js 传过来的是经过一次sha1加密的密码
         raise APIValueError('password')
 
-    user = yield from User.find_all(where='email=?', args=[email])
-    if user:
-        raise APIError('register:failed', 'email', 'already exist')
     uid = create_id()
     # 又加密一次
     sha1_password = hashlib.sha1(('%s:%s' % (uid, password)).encode()).hexdigest()
     user = User(id=uid, email=email, name=name, password=sha1_password, avatar='/static/pics/default_avatar.png')
-    yield from user.save()
+    # email上有唯一索引 一条语句完成检查和插入 并发注册也不会重复
+    # ON DUPLICATE KEY UPDATE id=id: 已存在时什么都不改 和INSERT IGNORE不同 其他错误照常抛出
+    result = yield from user.upsert(update_fields=[])
+    if result != 'inserted':
+        raise APIError('register:failed', 'email', 'already exist')
 
     # set cookie
     resp = web.Response(content_type='application/json')
@@ -233,24 +309,61 @@ def api_get_json_blog(*, blog_id):
 
 @get('/api/blogs')
 @asyncio.coroutine
-def api_get_blogs(*, page=1):
+def api_get_blogs(*, page=1, cursor=None):
+    if cursor is not None:
+        return (yield from get_blogs_by_cursor(cursor))
     page_index = get_page_index(page)
-    blog_count = yield from Blog.count_rows('id')
-    p = Page(blog_count, page_index)
-    if blog_count == 0:
+    page_size = 10
+    # 内存里的行数 大部分请求不需要count查询 表很大时用information_schema的估计值
+    # offset直接由页码算出来 count和select可以同时查
+    blog_count, blogs = yield from orm.gather(
+        Blog.count_rows(approximate=True),
+        Blog.find_all(order_by='created_at DESC', limit=(page_size * (page_index - 1), page_size), defer=['content'],
+                      as_rows=True))
+    # limit 用来标记从第几行开始取值 取多少个
+    p = Page(blog_count, page_index, page_size, approximate=Blog.count_is_approximate())
+    if p.limit == 0:
+        # 没有日志 或者页码超出范围
         return dict(
             page=p,
             blogs=()
         )
 
-    blogs = yield from Blog.find_all(order_by='created_at DESC', limit=(p.offset, p.limit))
-    # limit 用来标记从第几行开始取值 取多少个
     return dict(
         page=p,
         blogs=blogs
     )
 
 
+@asyncio.coroutine
+def get_blogs_by_cursor(cursor, page_size=10):
+    # keyset分页: 每一页的代价都和第一页一样 也不需要count
+    # 多取一行 用来判断这个方向上还有没有下一页
+    if cursor:
+        direction, position = decode_cursor(cursor)
+        blogs = yield from Blog.find_all(limit=page_size + 1, defer=['content'], as_rows=True, **{direction: position})
+    else:
+        direction = 'after'
+        blogs = yield from Blog.find_all(order_by='created_at DESC, id DESC', limit=page_size + 1, defer=['content'],
+                                         as_rows=True)
+    more = len(blogs) > page_size
+    if direction == 'after':
+        blogs = blogs[:page_size]
+        has_next, has_previous = more, bool(cursor)
+    else:
+        blogs = blogs[-page_size:] if more else blogs
+        has_next, has_previous = True, more
+    return dict(
+        page=dict(
+            has_next=has_next and bool(blogs),
+            has_previous=has_previous and bool(blogs),
+            next_cursor=encode_cursor('after', blogs[-1]) if blogs else None,
+            prev_cursor=encode_cursor('before', blogs[0]) if blogs else None
+        ),
+        blogs=blogs
+    )
+
+
 @post('/api/blogs')
 @asyncio.coroutine
 def api_create_blog(request, *, name, summary, content):
@@ -280,24 +393,47 @@ def api_create_blog(request, *, name, summary, content):
 @asyncio.coroutine
 def api_delete_blog(request, *, blog_id):
     check_admin(request)
-    blog_to_delete = yield from Blog.find_by_primary_key(blog_id)
-    if not blog_to_delete:
+    # 直接删除 用row affected判断日志是否存在 不用先查一次
+    row_affected = yield from Blog.delete_many([blog_id])
+    if not row_affected:
         logging.info('blog [%s] does not exist' % blog_id)
         raise APIPermissionError('blog does not exist')
-    yield from blog_to_delete.delete()
     return dict(id=blog_id)
 
 
+@post('/api/blogs/delete')
+@asyncio.coroutine
+def api_delete_blogs(request, *, ids):
+    check_admin(request)
+    # json传入list 表单传入以逗号分隔的字符串
+    if isinstance(ids, str):
+        ids = ids.split(',')
+    if not isinstance(ids, list):
+        raise APIValueError('ids', 'ids必须是列表')
+    ids = [blog_id.strip() for blog_id in ids if isinstance(blog_id, str) and blog_id.strip()]
+    if not ids:
+        raise APIValueError('ids', '没有要删除的日志')
+    row_affected = yield from Blog.delete_many(ids)
+    return dict(ids=ids, deleted=row_affected)
+
+
 @post('/api/blogs/edit/{blog_id}')
 @asyncio.coroutine
-def api_edit_blog(request, *, name, summary, content, blog_id):
+def api_edit_blog(request, *, name, summary, content, blog_id, version=None):
     check_admin(request)
-    blog_to_edit = yield from Blog.find_by_primary_key(blog_id)
-    if not blog_to_edit:
+    # 只写这三个field 不用先把日志查出来
+    # 带上编辑页面拿到的version 期间被别人改过的话更新失败
+    blog_to_edit = Blog(id=blog_id, name=name, summary=summary, content=content)
+    if version is not None:
+        try:
+            blog_to_edit.version = int(version)
+        except (TypeError, ValueError):
+            raise APIValueError('version')
+    try:
+        row_affected = yield from blog_to_edit.update_data()
+    except StaleDataError:
+        raise APIError('edit:conflict', 'blog', '日志已被修改或删除 请刷新后再编辑')
+    if not row_affected:
         logging.info('blog [%s] does not exist' % blog_id)
         raise APIPermissionError('blog does not exist')
-    blog_to_edit.name = name
-    blog_to_edit.summary = summary
-    blog_to_edit.content = content
-    yield from blog_to_edit.update_data()
     return blog_to_edit
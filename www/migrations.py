@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online schema migrations
+
+    python3 migrations.py [--user root --password ...] [--chunk 500] [--sleep 0.05] [--max-lag 1|none]
+                          [--replicas host[:port],...] [--run name,...]
+    python3 migrations.py --status
+
+A migration is a name and a list of steps, declared in MIGRATIONS below and run in order:
+
+    Ddl(sql, unless=None)   run a statement once, skipped when the unless query returns a row
+    Backfill(model, ...)    walk the table by primary key, chunk_size rows per transaction
+
+Every chunk is committed together with its checkpoint (the last primary key done) in schema_migrations,
+so a stopped run goes on from the last chunk. Between chunks the runner sleeps, and waits while a replica
+lags behind more than max_lag seconds, or replication is broken, so the backfill does not stall production traffic.
+The replicas checked are configs['db']['replicas'] (dicts as in orm.create_db_pool), or --replicas.
+
+A migration that depends on a deploy is manual: the runner stops before it until it is named by --run.
+Converting blogs.content to compressed mediumblob without copying the table:
+
+    0001  add the nullable content_z column (before deploying the code with shadow='content_z')
+    0002  backfill content_z, --run it after every server runs that code, which writes both columns
+    0003  swap the columns, --run it while deploying the code with CompressedTextField(column_type='mediumblob')
+"""
+
+import sys
+import json
+import time
+import asyncio
+import logging
+
+import orm
+from orm import Model, StringField, BooleanField, IntField, FloatField, create_args_string, create_table_sql
+from model import User, Blog, Comment
+from conf.config import configs
+
+
+class MigrationCheckpoint(Model):
+    __table__ = 'schema_migrations'
+    __batch__ = None
+
+    id = StringField(column_type='varchar(200)', primary_key=True)  # '<migration name>:<step index>'
+    last_key = StringField(column_type='varchar(200)', default='')  # json of the last primary key done
+    rows = IntField()
+    done = BooleanField()
+    updated_at = FloatField(default=time.time)
+
+
+class Ddl(object):
+    """
+    A schema statement, e.g. Ddl('ALTER TABLE `blogs` ADD COLUMN `html` mediumtext, ALGORITHM=INPLACE, LOCK=NONE')
+
+    :param unless: a select returning a row when the change is already there (e.g. a fresh schema.sql)
+    """
+    def __init__(self, sql, unless=None):
+        self.sql = sql
+        self.unless = unless
+
+    def __str__(self):
+        return self.sql
+
+    async def run(self, runner, checkpoint):
+        if self.unless:
+            # 在主库上检查 副本可能还没执行到这个改动
+            async with orm.transaction():
+                done = await orm.select(self.unless, (), 1)
+            if done:
+                logging.info('[Migration]: Skip %s' % self.sql)
+                return
+        await orm.execute(self.sql)
+
+
+class Backfill(object):
+    """
+    Update the rows of a model chunk by chunk in primary key order
+
+    Either set, an assignment list run on every chunk:
+        Backfill(Blog, set='`comment_count`=(SELECT COUNT(*) FROM `comments` WHERE `blog_id`=`blogs`.`id`)')
+    or transform, a function of a row dict (primary key and columns) returning a dict of new values or None:
+        Backfill(Blog, columns=['content'], transform=lambda row: dict(html=render(row['content'])))
+    A transform only writes a row whose changed columns still have the values it read.
+
+    :param where: only rows matching this condition
+    """
+    def __init__(self, model, set=None, transform=None, columns=None, where=None):
+        if (set is None) == (transform is None):
+            raise ValueError('[Migration]: Backfill needs either set or transform')
+        self.model = model
+        self.set = set
+        self.transform = transform
+        self.columns = list(columns or [])
+        self.where = where
+
+    def __str__(self):
+        return 'Backfill %s %s' % (self.model.__table__, self.set or self.transform.__name__)
+
+    async def run(self, runner, checkpoint):
+        table, primary_key = self.model.__table__, self.model.__primary_key__
+        select_sql = 'SELECT %s FROM `%s` WHERE `%s` > ?%s ORDER BY `%s` LIMIT ?' % (
+            ', '.join('`%s`' % c for c in [primary_key] + self.columns), table, primary_key,
+            ' AND (%s)' % self.where if self.where else '', primary_key)
+        last_key = json.loads(checkpoint.last_key) if checkpoint.last_key else ''
+        total = await self.model.count_rows(approximate=True)
+        start, done = time.time(), 0
+        while True:
+            # 从主库读 副本可能还没有刚写进去的行
+            chunk_start = time.time()
+            async with orm.transaction():
+                rows = await orm.select(select_sql, [last_key, runner.chunk_size])
+                if not rows:
+                    break
+                keys = [row[primary_key] for row in rows]
+                if self.set:
+                    await orm.execute('UPDATE `%s` SET %s WHERE `%s` IN (%s)' % (
+                        table, self.set, primary_key, create_args_string(len(keys))), keys)
+                else:
+                    for row in rows:
+                        await self.update_row(row)
+                last_key = rows[-1][primary_key]
+                checkpoint.last_key = json.dumps(last_key)
+                checkpoint.rows += len(rows)
+                checkpoint.updated_at = time.time()
+                await checkpoint.upsert()
+                for key in keys:
+                    # 在事务里记下 提交之后才清缓存
+                    self.model.invalidate_cache(key)
+            done += len(rows)
+            runner.report(checkpoint, done, total, time.time() - start)
+            await runner.throttle(time.time() - chunk_start)
+
+    async def update_row(self, row):
+        values = self.transform(row)
+        if not values:
+            return
+        names = list(values)
+        sql = 'UPDATE `%s` SET %s WHERE `%s`=?' % (
+            self.model.__table__, ', '.join('`%s`=?' % n for n in names), self.model.__primary_key__)
+        args = [values[n] for n in names] + [row[self.model.__primary_key__]]
+        # 读出来之后被别人改过的行不覆盖
+        for name in names:
+            if name in row:
+                sql += ' AND `%s`<=>?' % name
+                args.append(row[name])
+        await orm.execute(sql, args)
+
+
+class Migration(object):
+    """:param manual: only run when named by --run, the migrations after it wait too"""
+    def __init__(self, name, steps, manual=False):
+        self.name = name
+        self.steps = steps
+        self.manual = manual
+
+
+class MigrationRunner(object):
+    """
+    Runs migrations and records their progress in schema_migrations
+
+    :param chunk_size: rows per backfill transaction
+    :param pause: seconds to sleep between chunks, at least sleep_ratio * the time the chunk took
+    :param max_lag: wait while a replica is more than max_lag seconds behind, None to not check
+    """
+    def __init__(self, chunk_size=500, pause=0.05, sleep_ratio=0.5, max_lag=1, lag_check_interval=1):
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.sleep_ratio = sleep_ratio
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._last_report = 0
+
+    async def setup(self):
+        sql = create_table_sql(MigrationCheckpoint).replace('create table', 'create table if not exists', 1)
+        await orm.execute(sql)
+
+    async def run(self, migrations, manual=()):
+        await self.setup()
+        for migration in migrations:
+            checkpoints = []
+            for idx in range(len(migration.steps)):
+                checkpoint_id = '%s:%s' % (migration.name, idx)
+                async with orm.transaction():
+                    checkpoint = await MigrationCheckpoint.find_by_primary_key(checkpoint_id)
+                if checkpoint is None:
+                    checkpoint = MigrationCheckpoint(id=checkpoint_id, last_key='', rows=0, done=False)
+                checkpoints.append(checkpoint)
+            if all(c.done for c in checkpoints):
+                continue
+            if migration.manual and migration.name not in manual:
+                logging.info('[Migration]: Stop before %s, run it with --run %s' % (migration.name, migration.name))
+                return
+            for idx, (step, checkpoint) in enumerate(zip(migration.steps, checkpoints)):
+                if checkpoint.done:
+                    continue
+                logging.info('[Migration]: %s step %s: %s' % (migration.name, idx, step))
+                await step.run(self, checkpoint)
+                checkpoint.done = True
+                checkpoint.updated_at = time.time()
+                await checkpoint.upsert()
+                logging.info('[Migration]: %s step %s done' % (migration.name, idx))
+
+    async def throttle(self, chunk_time):
+        await asyncio.sleep(max(self.pause, chunk_time * self.sleep_ratio))
+        if self.max_lag is None:
+            return
+        while True:
+            lags = await orm.replica_lag()
+            # None: 不是副本(e.g. 本地的测试库); 复制中断或查不到延迟(inf)要等
+            lagging = {name: lag for name, lag in lags.items() if lag is not None and lag > self.max_lag}
+            if not lagging:
+                return
+            logging.warning('[Migration]: Waiting for replicas: %s' % lagging)
+            await asyncio.sleep(self.lag_check_interval)
+
+    def report(self, checkpoint, done, total, elapsed, interval=5):
+        now = time.time()
+        if now - self._last_report < interval:
+            return
+        self._last_report = now
+        rate = done / elapsed if elapsed else 0
+        logging.info('[Migration]: %s: %s rows (~%s in table), %.0f rows/s, last key %s' %
+                     (checkpoint.id, int(checkpoint.rows), total, rate, checkpoint.last_key))
+
+
+def add_index_steps(model, *names):
+    """
+    Ddl steps adding indexes declared on a model (__indexes__ and Field(index=...)), skipped where they exist
+
+    The names are listed, so an index declared later does not shift the steps of an old migration.
+    """
+    indexes = {index.name: index for index in model.__indexes__}
+    return [Ddl('ALTER TABLE `%s` ADD %sINDEX `%s` (%s), ALGORITHM=INPLACE, LOCK=NONE' % (
+                    model.__table__, 'UNIQUE ' if index.unique else '', index.name,
+                    ', '.join('`%s`' % c for c in index.columns)),
+                unless='SELECT 1 FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() '
+                       'AND TABLE_NAME = \'%s\' AND INDEX_NAME = \'%s\'' % (model.__table__, index.name))
+            for index in map(indexes.__getitem__, names)]
+
+
+def _compress_content(row):
+    # content列里是文本 压缩一份写进content_z
+    field = Blog.__mappings__['content']
+    value = row['content']
+    if value is None or row['content_z'] is not None:
+        return None
+    return dict(content_z=field.to_db(field.from_db(value)))
+
+
+MIGRATIONS = [
+    # 和conf/schema.sql一致: 乐观锁的version列 加上model里声明的索引
+    Migration('0000_add_blog_version_and_indexes', [
+        Ddl('ALTER TABLE `blogs` ADD COLUMN `version` bigint not null default 0, ALGORITHM=INPLACE, LOCK=NONE',
+            unless='SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() '
+                   'AND TABLE_NAME = \'blogs\' AND COLUMN_NAME = \'version\''),
+    ] + add_index_steps(User, 'idx_email', 'idx_created_at')
+      + add_index_steps(Blog, 'idx_user_id', 'idx_created_at')
+      + add_index_steps(Comment, 'idx_blog_id_created_at', 'idx_user_id', 'idx_created_at')),
+    # 改列类型要拷贝整张表 期间不能写: 加一个新列 两列都写 回填之后再交换
+    Migration('0001_add_blog_content_z', [
+        Ddl('ALTER TABLE `blogs` ADD COLUMN `content_z` mediumblob null, ALGORITHM=INPLACE, LOCK=NONE',
+            unless='SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() '
+                   'AND TABLE_NAME = \'blogs\' AND COLUMN_NAME IN (\'content_z\', \'content_text\')'),
+    ]),
+    Migration('0002_backfill_blog_content_z', [
+        # 只写content_z还是NULL的行 回填期间编辑过的行已经由新代码写好了
+        Backfill(Blog, columns=['content', 'content_z'], transform=_compress_content, where='`content_z` IS NULL'),
+    ], manual=True),
+    Migration('0003_swap_blog_content', [
+        # 只改名字和NULL属性 不改类型 可以在线执行
+        Ddl('ALTER TABLE `blogs` CHANGE `content` `content_text` mediumtext null, '
+            'CHANGE `content_z` `content` mediumblob not null, ALGORITHM=INPLACE, LOCK=NONE',
+            unless='SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() '
+                   'AND TABLE_NAME = \'blogs\' AND COLUMN_NAME = \'content_text\''),
+    ], manual=True),
+]
+
+
+def parse_replicas(value):
+    """'host[:port],...' => the replicas argument of orm.create_db_pool"""
+    replicas = []
+    for address in value.split(','):
+        host, _, port = address.strip().partition(':')
+        replica = dict(name=address.strip(), host=host)
+        if port:
+            replica['port'] = int(port)
+        replicas.append(replica)
+    return replicas
+
+
+def parse_max_lag(value):
+    """'none' turns the replication lag check off"""
+    return None if value.lower() == 'none' else float(value)
+
+
+async def main(loop, options):
+    db = configs['db']
+    replicas = parse_replicas(options['--replicas']) if '--replicas' in options else db.get('replicas', None)
+    if not replicas and '--status' not in options:
+        logging.warning('[Migration]: No replicas configured, replication lag is not checked')
+    # 改表结构要ALTER/CREATE权限 blog-data没有
+    await orm.create_db_pool(loop=loop, host=db['host'], port=db['port'],
+                                  user=options.get('--user', db['user']),
+                                  password=options.get('--password', db['password']), db=db['database'],
+                                  replicas=replicas)
+    try:
+        runner = MigrationRunner(chunk_size=int(options.get('--chunk', 500)),
+                                 pause=float(options.get('--sleep', 0.05)),
+                                 max_lag=parse_max_lag(options.get('--max-lag', '1')))
+        if '--status' in options:
+            await runner.setup()
+            for checkpoint in (await MigrationCheckpoint.find_all(order_by='id', query_cache=False)):
+                print('%-40s %-6s %10d rows  last key %s' % (checkpoint.id, 'done' if checkpoint.done else '',
+                                                             checkpoint.rows, checkpoint.last_key))
+        else:
+            await runner.run(MIGRATIONS, options['--run'].split(',') if '--run' in options else ())
+    finally:
+        await orm.destroy_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    args = sys.argv[1:]
+    cli_options = {}
+    while args:
+        key = args.pop(0)
+        cli_options[key] = args.pop(0) if key != '--status' and args else True
+    event_loop = asyncio.get_event_loop()
+    event_loop.run_until_complete(main(event_loop, cli_options))
+    event_loop.close()
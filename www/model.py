@@ -1,46 +1,59 @@
 """models"""
 
 import time
-import uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, CompressedTextField, ForeignKey, HasMany, \
+    Index, VersionField, next_id, encode_id
 
 
 def create_id():
-    return '%15d%s000' % (time.time(), uuid.uuid4().hex)
+    # 13位的k-sortable id: 按时间递增 新行插在主键索引的末尾 不再随机分散
+    # 比原来的 时间戳+uuid4 短很多 二级索引里每行都带着主键
+    return encode_id(next_id())
 
 
 class User(Model):
     __table__ = 'users'
+    # cookie2user 每个请求都会按主键查一次用户
+    __cache__ = dict(size=10000, ttl=60)
 
     id = StringField(column_type='varchar(50)', primary_key=True, default=create_id)
-    email = StringField(column_type='varchar(50')
+    email = StringField(column_type='varchar(50)', index='unique')
     name = StringField(column_type='varchar(50)')
     password = StringField(column_type='varchar(50)')
     avatar = StringField(column_type='varchar(500)')  # 头像
     admin = BooleanField()  # 默认不是管理员
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(size=10000, ttl=60)
 
     id = StringField(column_type='varchar(50)', primary_key=True, default=create_id)
-    user_id = StringField(column_type='varchar(50)')
+    user_id = ForeignKey('User')
     user_name = StringField(column_type='varchar(50)')
     user_avatar = StringField(column_type='varchar(500)')
     name = StringField(column_type='varchar(50)')
     summary = StringField(column_type='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    # markdown压缩后只有原来的1/3到1/5 存储 复制和传输的都是压缩后的
+    # 转换期间(migrations.py 0001-0003): 文本还写在content列 压缩后的写进content_z 读content_z
+    content = CompressedTextField(column_type='mediumtext', shadow='content_z')
+    created_at = FloatField(default=time.time, index=True)
+    # 乐观锁 编辑日志时不用先查一次
+    version = VersionField()
+
+    comments = HasMany('Comment', foreign_key='blog_id', order_by='created_at DESC')
 
 
 class Comment(Model):
     __table__ = 'comments'
+    # read_blog: WHERE blog_id=? ORDER BY created_at DESC
+    __indexes__ = [Index('idx_blog_id_created_at', 'blog_id', 'created_at')]
 
     id = StringField(primary_key=True, default=create_id, column_type='varchar(50)')
-    blog_id = StringField(column_type='varchar(50)')
-    user_id = StringField(column_type='varchar(50)')
+    blog_id = ForeignKey('Blog', index=False)
+    user_id = ForeignKey('User')
     user_name = StringField(column_type='varchar(50)')
     user_avatar = StringField(column_type='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(column_type='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import time
+import zlib
+import re
 import logging
+import functools
+import contextlib
 import asyncio
 import aiomysql
+import contextvars
+from collections import OrderedDict, deque, namedtuple
 logging.basicConfig()
 
 
@@ -11,6 +20,30 @@ def log(sql, args=()):
     logging.info('[SQL]: %s, Args: %s' % (sql, args or 'None'))
 
 __pool = None
+# 只读副本 create_db_pool传入replicas时才有
+_replicas = None
+# 当前请求最后一次写操作的时间 每个请求(task)有自己的一份
+_last_write = contextvars.ContextVar('last_write', default=0)
+
+
+@asyncio.coroutine
+def _create_pool(loop, user, password, db, kwargs, name='primary'):
+    pool = yield from aiomysql.create_pool(
+        host=kwargs.get('host', 'localhost'),
+        # 3306 is the default mysql port
+        port=kwargs.get('port', 3306),  # port is an integer
+        charset=kwargs.get('charset', 'utf8'),  # 尼玛为什么是utf8 No dash line ？？？
+        maxsize=kwargs.get('maxsize', 10),
+        minsize=kwargs.get('minsize', 1),
+        autocommit=kwargs.get('autocommit', True),
+        user=user,
+        password=password,
+        db=db,
+        loop=loop
+    )
+    return InstrumentedPool(pool, name, kwargs.get('minsize', 1), kwargs.get('maxsize', 10),
+                            kwargs.get('adaptive', False), kwargs.get('adapt_interval', 10),
+                            kwargs.get('grow_wait', 0.005))
 
 
 @asyncio.coroutine
@@ -18,100 +51,1494 @@ def create_db_pool(loop, user, password, db, **kwargs):
     """
     Create a global database pool
 
-    :param loop: event loop of the web application
-    :param user: username of the database
-    :param password:
-    :param db: database name
-    :param kwargs:
-    :return: No return
+    Read/write split: replicas=[dict(host=..., port=..., weight=2), ...] creates a pool per replica.
+    select() goes to the replicas by weighted round robin and execute() to the primary. A replica dict
+    may also override user, password, db and the pool sizes, so local stand-in databases work for tests.
+
+    :param loop: event loop of the web application
+    :param user: username of the database
+    :param password:
+    :param db: database name
+    :param kwargs: replicas, read_your_writes (seconds reads go to the primary after a write in the same request),
+                   replica_cache_ttl (max seconds rows read from replicas stay in the caches, default read_your_writes),
+                   health_check_interval,
+                   adaptive (let the number of connections in use move between minsize and maxsize),
+                   adapt_interval, grow_wait (average checkout wait in seconds above which an adaptive pool grows),
+                   write_buffer_rows, write_buffer_delay (flush thresholds of save(deferred=True)),
+                   worker_id (of next_id(), unique per process, default pid % 1024)
+    :return: No return
+    """
+    logging.info('[DB]: Create database connecting pool')
+    global __pool, _replicas
+    __pool = yield from _create_pool(loop, user, password, db, kwargs)
+    replicas = kwargs.get('replicas', None)
+    if replicas:
+        _replicas = ReplicaSet(kwargs.get('read_your_writes', 2), kwargs.get('health_check_interval', 5),
+                               kwargs.get('replica_cache_ttl', None))
+        for idx, config in enumerate(replicas):
+            replica_config = dict(kwargs, **config)
+            name = config.get('name', 'replica%s' % idx)
+            pool = yield from _create_pool(loop, replica_config.get('user', user),
+                                           replica_config.get('password', password),
+                                           replica_config.get('db', db), replica_config, name)
+            logging.info('[DB]: Create replica pool %s' % name)
+            _replicas.add(name, pool, config.get('weight', 1))
+        _replicas.start_health_check(loop)
+    # 查询结果缓存 默认关闭
+    configure_query_cache(kwargs.get('query_cache_bytes', 0), kwargs.get('query_cache_ttl', 60))
+    configure_write_buffer(kwargs.get('write_buffer_rows', 500), kwargs.get('write_buffer_delay', 0.05))
+    if 'worker_id' in kwargs:
+        configure_id_generator(kwargs['worker_id'])
+
+
+@asyncio.coroutine
+def destroy_pool():  # 销毁连接池
+    global __pool, _replicas
+    # 先把缓冲区里的行写进去
+    yield from _write_buffer.drain()
+    if _replicas is not None:
+        yield from _replicas.close()
+        _replicas = None
+    if __pool is not None:
+        __pool.close()
+        yield from __pool.wait_closed()
+
+
+class Histogram(object):
+    """Counts of observed durations (seconds) in fixed buckets"""
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        # 返回所在bucket的上界
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return self.max if bound == float('inf') else min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        return dict(
+            count=self.count,
+            mean=self.sum / self.count if self.count else 0.0,
+            max=self.max,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            buckets=dict(zip(map(str, self.BUCKETS), self.counts))
+        )
+
+
+class _PoolConnectionContext(object):
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __enter__(self):
+        return self._conn
+
+    def __exit__(self, *exc_info):
+        self._pool.release(self._conn)
+
+
+class InstrumentedPool(object):
+    """
+    aiomysql pool wrapper that records checkout wait time, hold time, connections in use and queue depth
+
+    Supports both `with (yield from pool) as conn` and pool.acquire()/pool.release(conn) like the aiomysql pool.
+    With adaptive=True the number of connections that can be checked out at the same time (limit) starts in the
+    middle of [minsize, maxsize], grows by one when the average wait of the last adapt_interval seconds is above
+    grow_wait and shrinks by one when nobody waited and fewer connections than the limit were used.
+    """
+    def __init__(self, pool, name, minsize, maxsize, adaptive=False, adapt_interval=10, grow_wait=0.005):
+        self._pool = pool
+        self.name = name
+        self.minsize = max(minsize, 1)
+        self.maxsize = maxsize
+        self.adaptive = adaptive
+        self.adapt_interval = adapt_interval
+        self.grow_wait = grow_wait
+        self.limit = (self.minsize + maxsize + 1) // 2 if adaptive else maxsize
+        self.in_use = 0
+        self.waiting = 0
+        self._waiters = deque()
+        self._checkout_at = {}  # id(conn) => checkout time
+        self.wait_time = Histogram()
+        self.hold_time = Histogram()
+        self.queue_depth = Histogram()
+        # 自适应用 统计上次调整之后的数据
+        self._adapted_at = time.time()
+        self._window_wait = 0.0
+        self._window_count = 0
+        self._window_peak = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        start = time.perf_counter()
+        self.queue_depth.observe(self.waiting)
+        self.waiting += 1
+        try:
+            while self.in_use >= self.limit:
+                waiter = asyncio.get_event_loop().create_future()
+                self._waiters.append(waiter)
+                try:
+                    yield from waiter
+                except asyncio.CancelledError:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    else:
+                        # 已经被唤醒了 把机会让给下一个
+                        self._wake_up()
+                    raise
+            self.in_use += 1
+            try:
+                conn = yield from self._pool.acquire()
+            except:
+                self.in_use -= 1
+                self._wake_up()
+                raise
+        finally:
+            self.waiting -= 1
+        now = time.perf_counter()
+        self.wait_time.observe(now - start)
+        self._window_wait += now - start
+        self._window_count += 1
+        self._window_peak = max(self._window_peak, self.in_use)
+        self._checkout_at[id(conn)] = now
+        return conn
+
+    def release(self, conn):
+        checkout_at = self._checkout_at.pop(id(conn), None)
+        if checkout_at is not None:
+            self.hold_time.observe(time.perf_counter() - checkout_at)
+        self._pool.release(conn)
+        self.in_use -= 1
+        if self.adaptive and self._adapted_at + self.adapt_interval < time.time():
+            self._adapt()
+        self._wake_up()
+
+    def _wake_up(self):
+        # 有空位就唤醒等待的协程 被唤醒的协程会再检查一次in_use
+        free = self.limit - self.in_use
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _adapt(self):
+        average_wait = self._window_wait / self._window_count if self._window_count else 0.0
+        if average_wait > self.grow_wait and self.limit < self.maxsize:
+            self.limit += 1
+            logging.info('[DB]: Pool %s grows to %s connections, average wait %.4fs'
+                         % (self.name, self.limit, average_wait))
+        elif average_wait < self.grow_wait / 10 and self._window_peak < self.limit and self.limit > self.minsize:
+            self.limit -= 1
+            logging.info('[DB]: Pool %s shrinks to %s connections' % (self.name, self.limit))
+            if self._pool.freesize > self.limit:
+                # 关掉空闲的连接 用到时再建
+                asyncio.ensure_future(self._pool.clear())
+        self._adapted_at = time.time()
+        self._window_wait = 0.0
+        self._window_count = 0
+        self._window_peak = self.in_use
+
+    def __iter__(self):
+        conn = yield from self.acquire()
+        return _PoolConnectionContext(self, conn)
+
+    def close(self):
+        self._pool.close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        yield from self._pool.wait_closed()
+
+    @asyncio.coroutine
+    def clear(self):
+        yield from self._pool.clear()
+
+    def stats(self):
+        return dict(
+            limit=self.limit,
+            minsize=self.minsize,
+            maxsize=self.maxsize,
+            size=self._pool.size,
+            in_use=self.in_use,
+            idle=self._pool.freesize,
+            waiting=self.waiting,
+            wait_time=self.wait_time.stats(),
+            hold_time=self.hold_time.stats(),
+            queue_depth=self.queue_depth.stats()
+        )
+
+
+def pool_stats():
+    """
+    Statistics of the primary pool and the replica pools
+
+    :return: dict of pool name => dict(limit, size, in_use, idle, waiting, wait_time, hold_time, queue_depth)
+             the last three are histograms in seconds (queue depth in number of waiting coroutines)
+    """
+    stats = {}
+    if __pool is not None:
+        stats[__pool.name] = __pool.stats()
+    if _replicas is not None:
+        for replica in _replicas.replicas.values():
+            stats[replica['pool'].name] = replica['pool'].stats()
+    return stats
+
+
+class ReplicaSet(object):
+    """
+    Read replicas chosen by smooth weighted round robin
+
+    A replica whose query or health check fails is ejected until a later health check succeeds.
+    """
+    def __init__(self, read_your_writes=2, health_check_interval=5, cache_ttl=None):
+        self.read_your_writes = read_your_writes
+        self.cache_ttl = read_your_writes if cache_ttl is None else cache_ttl
+        self.health_check_interval = health_check_interval
+        self.replicas = OrderedDict()  # name => dict(pool, weight, current, healthy)
+        self._health_check = None
+
+    def add(self, name, pool, weight=1):
+        self.replicas[name] = dict(pool=pool, weight=weight, current=0, healthy=True)
+
+    def choose(self):
+        """:return: (name, pool) of the next healthy replica, or (None, None) if there is none"""
+        total = 0
+        chosen_name = None
+        for name, replica in self.replicas.items():
+            if not replica['healthy']:
+                continue
+            replica['current'] += replica['weight']
+            total += replica['weight']
+            if chosen_name is None or replica['current'] > self.replicas[chosen_name]['current']:
+                chosen_name = name
+        if chosen_name is None:
+            return None, None
+        chosen = self.replicas[chosen_name]
+        chosen['current'] -= total
+        return chosen_name, chosen['pool']
+
+    def eject(self, name):
+        if self.replicas[name]['healthy']:
+            logging.warning('[DB]: Replica %s ejected' % name)
+        self.replicas[name]['healthy'] = False
+
+    @asyncio.coroutine
+    def check(self, name):
+        replica = self.replicas[name]
+        try:
+            with (yield from replica['pool']) as conn:
+                cur = yield from conn.cursor()
+                yield from asyncio.wait_for(cur.execute('SELECT 1'), self.health_check_interval)
+                yield from cur.close()
+        except Exception as e:
+            logging.warning('[DB]: Health check of replica %s failed: %s' % (name, e))
+            self.eject(name)
+            return False
+        if not replica['healthy']:
+            logging.info('[DB]: Replica %s is back' % name)
+        replica['healthy'] = True
+        return True
+
+    def start_health_check(self, loop):
+        @asyncio.coroutine
+        def health_check():
+            while True:
+                yield from asyncio.sleep(self.health_check_interval)
+                for name in list(self.replicas):
+                    yield from self.check(name)
+        self._health_check = loop.create_task(health_check())
+
+    @asyncio.coroutine
+    def close(self):
+        if self._health_check is not None:
+            self._health_check.cancel()
+        for replica in self.replicas.values():
+            replica['pool'].close()
+            yield from replica['pool'].wait_closed()
+
+    @asyncio.coroutine
+    def lag(self, name):
+        """
+        :return: Seconds_Behind_Master of a replica, None if the server is not a replica,
+                 inf if Seconds_Behind_Master is NULL (replication stopped or broken)
+        """
+        with (yield from self.replicas[name]['pool']) as conn:
+            cur = yield from conn.cursor(aiomysql.DictCursor)
+            yield from cur.execute('SHOW SLAVE STATUS')
+            status = yield from cur.fetchone()
+            yield from cur.close()
+        if not status:
+            return None
+        lag = status.get('Seconds_Behind_Master')
+        return float('inf') if lag is None else lag
+
+    def stats(self):
+        return {name: dict(weight=r['weight'], healthy=r['healthy']) for name, r in self.replicas.items()}
+
+
+@asyncio.coroutine
+def replica_lag():
+    """
+    :return: dict of replica name => replication lag in seconds, {} without replicas.
+             None for a server that is not a replica, inf where replication is broken or the lag is unknown
+    """
+    if _replicas is None:
+        return {}
+    lags = {}
+    for name, replica in _replicas.replicas.items():
+        if not replica['healthy']:
+            # 被摘掉的副本查不到延迟 不能当成没有延迟
+            lags[name] = float('inf')
+            continue
+        try:
+            lags[name] = yield from _replicas.lag(name)
+        except Exception as e:
+            logging.warning('[DB]: Failed to get the lag of replica %s: %s' % (name, e))
+            lags[name] = float('inf')
+    return lags
+
+
+def wrote_recently():
+    """If reads of the current request must go to the primary to see its own writes"""
+    return _replicas is not None and _last_write.get() + _replicas.read_your_writes > time.time()
+
+
+def replica_cache_ttl():
+    """
+    Max seconds a result read from a replica may be cached, None without replicas
+
+    A replica can return a row as it was before a write of another request; the version checks of the caches
+    only catch writes during the query, so such rows are only kept about as long as the replica may lag.
+    """
+    return _replicas.cache_ttl if _replicas is not None else None
+
+
+def read_pool():
+    """
+    Choose the pool for a read: a replica, or the primary if there is no healthy replica
+    or the current request wrote recently (read your writes)
+
+    :return: (replica name or None, pool)
+    """
+    if _replicas is None or wrote_recently():
+        return None, __pool
+    name, pool = _replicas.choose()
+    if pool is None:
+        return None, __pool
+    return name, pool
+
+
+class QueryStats(object):
+    """
+    The statements one request (or one test block) ran, by normalized statement shape
+
+    A shape that runs more than n_plus_one times is logged once as a warning: it is usually a query
+    in a loop that should be one IN query (find_all(where='`id` IN (...)'), load_related, BatchLoader).
+    Queries answered by the query cache or the row cache do not count.
+    """
+    def __init__(self, n_plus_one=10, parent=None):
+        self.n_plus_one = n_plus_one
+        self.parent = parent
+        self.shapes = OrderedDict()  # shape => [count, seconds]
+        self.total = 0
+        self.time = 0.0
+
+    def record(self, sql, seconds, warn=True):
+        shape = normalize_sql(sql)
+        item = self.shapes.get(shape)
+        if item is None:
+            item = self.shapes[shape] = [0, 0.0]
+        item[0] += 1
+        item[1] += seconds
+        self.total += 1
+        self.time += seconds
+        if warn and item[0] == self.n_plus_one + 1:
+            logging.warning('[ORM]: Possible N+1 query, ran %s times in one request: %s' % (item[0], shape))
+        if self.parent is not None:
+            # 内层已经检查过了 不重复警告
+            self.parent.record(sql, seconds, warn=False)
+
+    def most_common(self, n=5):
+        """:return: [(shape, count, seconds)] of the n most run shapes"""
+        return sorted(((shape, c, t) for shape, (c, t) in self.shapes.items()), key=lambda i: -i[1])[:n]
+
+
+_query_stats = contextvars.ContextVar('query_stats', default=None)
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """The shape of a statement: literals replaced by ?, IN lists folded, whitespace collapsed"""
+    shape = re.sub(r"'(?:[^'\\]|\\.|'')*'", '?', sql)
+    shape = re.sub(r'\b\d+(?:\.\d+)?\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', shape)
+    # save_many的多行values
+    shape = re.sub(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+', '(...)', shape)
+    return ' '.join(shape.split())
+
+
+@contextlib.contextmanager
+def track_queries(n_plus_one=10):
+    """
+    Count the statements run by the current task (and the tasks it starts) inside the block
+
+    e.g.  with orm.track_queries() as stats:
+              yield from handler(request)
+          logging.info('%s queries' % stats.total)
+
+    A nested block counts its statements in the outer one too.
+    """
+    stats = QueryStats(n_plus_one, _query_stats.get())
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+@contextlib.contextmanager
+def query_budget(max_queries, max_per_shape=None):
+    """
+    Test helper: raise AssertionError if the block runs more than max_queries statements
+    (or one shape more than max_per_shape times)
+
+    e.g.  with orm.query_budget(3):
+              await handlers.read_blog(blog_id, request)
+    """
+    with track_queries() as stats:
+        yield stats
+    if stats.total > max_queries:
+        raise AssertionError('%s queries, the budget is %s:\n%s' % (
+            stats.total, max_queries, '\n'.join('%4d  %s' % (c, shape) for shape, c, _ in stats.most_common(10))))
+    if max_per_shape is not None:
+        for shape, c, _ in stats.most_common(1):
+            if c > max_per_shape:
+                raise AssertionError('%s ran %s times, the budget is %s' % (shape, c, max_per_shape))
+
+
+def _record_query(sql, start):
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record(sql, time.perf_counter() - start)
+
+
+@functools.lru_cache(maxsize=1024)
+def limit_sql(sql, number):
+    """Add LIMIT number to a select without its own limit clause, so the server only sends number rows"""
+    if not sql.lstrip().upper().startswith('SELECT') or \
+            re.search(r'\blimit\b|\bfor\s+update\b|\bshare\s+mode\b', sql, re.I):
+        return sql
+    return '%s LIMIT %d' % (sql.rstrip().rstrip(';'), number)
+
+
+@functools.lru_cache(maxsize=4096)
+def to_driver_sql(sql):
+    # ORM里用?做占位符 aiomysql用%s, 每种语句只转换一次
+    return sql.replace('?', '%s')
+
+
+@asyncio.coroutine
+def select(sql, args=(), number=None, tuples=False):
+    """
+    :param number: fetch at most number rows
+    :param tuples: return rows as plain tuples instead of dicts
+    """
+    log(sql, args)
+    start = time.perf_counter()
+    tx = _current_transaction.get()
+    if tx is not None:
+        # 事务里的查询用事务的连接 能看到事务里还没提交的数据
+        res = yield from tx.run(_fetch, sql, args, number, tuples)
+    else:
+        name, pool = read_pool()
+        try:
+            res = yield from _select(pool, sql, args, number, tuples)
+        except aiomysql.OperationalError:
+            if name is None:
+                raise
+            # 副本连不上 踢掉之后到主库重试
+            _replicas.eject(name)
+            res = yield from _select(__pool, sql, args, number, tuples)
+    logging.info('[SQL]: %s row returned' % len(res))
+    _record_query(sql, start)
+    if _plan_checker is not None:
+        yield from _plan_checker.check(sql, args)
+    return res
+
+
+@asyncio.coroutine
+def _select(pool, sql, args, number, tuples=False):
+    with (yield from pool) as conn:
+        return (yield from _fetch(conn, sql, args, number, tuples))
+
+
+@asyncio.coroutine
+def _fetch(conn, sql, args, number, tuples=False):
+    cur = yield from conn.cursor(aiomysql.Cursor if tuples else aiomysql.DictCursor)
+    # 普通cursor在execute时就读完了整个结果集 fetchmany只是截断 行数限制要放进sql里
+    yield from cur.execute(to_driver_sql(limit_sql(sql, number) if number else sql), args)
+    if number:
+        res = yield from cur.fetchmany(number)
+    else:
+        res = yield from cur.fetchall()
+    yield from cur.close()
+    return res
+
+
+async def select_iter(sql, args=(), chunk_size=500, tuples=False):
+    """
+    Iterate over the result of a select statement chunk by chunk
+
+    Uses an unbuffered server-side cursor, so only one chunk of rows is held in memory at a time.
+    The connection is kept checked out until the iteration is finished.
+
+    :param chunk_size: number of rows fetched per round trip
+    :param tuples: rows as plain tuples instead of dicts
+    :return: an async iterator of row lists
+    """
+    log(sql, args)
+    start = time.perf_counter()
+    tx = _current_transaction.get()
+    if tx is not None:
+        # 等正在执行的语句结束后占住连接; 迭代期间不持有锁 同一个task里的其他语句直接报错 而不是一直等下去
+        tx.check_idle()
+        async with tx.lock:
+            tx.check_idle()
+            tx.streaming = sql
+        try:
+            async for rows in _iter_rows(tx.conn, sql, args, chunk_size, tuples):
+                yield rows
+        finally:
+            tx.streaming = None
+            _record_query(sql, start)
+        return
+    pool = read_pool()[1]
+    conn = await pool.acquire()
+    try:
+        async for rows in _iter_rows(conn, sql, args, chunk_size, tuples):
+            yield rows
+    finally:
+        pool.release(conn)
+        _record_query(sql, start)
+
+
+async def _iter_rows(conn, sql, args, chunk_size, tuples=False):
+    cur = await conn.cursor(aiomysql.SSCursor if tuples else aiomysql.SSDictCursor)
+    try:
+        await cur.execute(to_driver_sql(sql), args)
+        while True:
+            rows = await cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        # 未读完的行会在close时被丢弃 否则连接无法复用
+        await cur.close()
+
+
+@asyncio.coroutine
+def execute(sql, args=()):
+    log(sql, args)
+    start = time.perf_counter()
+    tx = _current_transaction.get()
+    if tx is not None:
+        # 事务里的语句不单独提交 出错时由transaction()回滚
+        affected = yield from tx.run(_execute, sql, args)
+    else:
+        with (yield from __pool) as conn:
+            try:
+                affected = yield from _execute(conn, sql, args)
+            except:
+                conn.rollback()
+                raise
+    # 之后一段时间内 这个请求的读操作都走主库
+    _last_write.set(time.time())
+    _record_query(sql, start)
+    return affected
+
+
+@asyncio.coroutine
+def _execute(conn, sql, args):
+    cur = yield from conn.cursor()
+    yield from cur.execute(to_driver_sql(sql), args)
+    affected = cur.rowcount
+    yield from cur.close()
+    return affected
+
+
+# 当前task正在进行的事务
+_current_transaction = contextvars.ContextVar('transaction', default=None)
+
+
+def in_transaction():
+    return _current_transaction.get() is not None
+
+
+class _TransactionState(object):
+    """The connection of an outermost transaction, shared by the nested ones"""
+    def __init__(self, conn):
+        self.conn = conn
+        # 同一个连接上的语句不能并发执行
+        self.lock = asyncio.Lock()
+        # select_iter正在读的语句: 未读完的unbuffered结果占着连接 这期间不能执行别的语句
+        self.streaming = None
+        self.savepoints = 0
+        # 提交或回滚之后再失效一次缓存: (model, primary key)
+        self.invalidations = []
+
+    @asyncio.coroutine
+    def run(self, fn, *args):
+        self.check_idle()
+        yield from self.lock.acquire()
+        try:
+            self.check_idle()
+            return (yield from fn(self.conn, *args))
+        finally:
+            self.lock.release()
+
+    def check_idle(self):
+        if self.streaming is not None:
+            raise RuntimeError('[ORM]: The transaction connection is still reading the rows of select_iter/iter_all '
+                               '(%s), finish the iteration first or load the rows with find_all' % self.streaming)
+
+
+class Transaction(object):
+    """
+    async with orm.transaction() as tx:
+
+    Every select/execute/Model operation of the current task inside the block uses one connection and
+    is committed once at the end, or rolled back if the block raises.
+    A nested transaction() becomes a savepoint of the outer one.
+    """
+    def __init__(self):
+        self._state = None
+        self._token = None
+        self._savepoint = None
+        self._mark = 0
+
+    @property
+    def conn(self):
+        return self._state.conn
+
+    async def __aenter__(self):
+        state = _current_transaction.get()
+        if state is None:
+            pool = _primary_pool()
+            conn = await pool.acquire()
+            try:
+                await conn.begin()
+            except:
+                pool.release(conn)
+                raise
+            self._state = _TransactionState(conn)
+            self._token = _current_transaction.set(self._state)
+        else:
+            self._state = state
+            state.savepoints += 1
+            self._savepoint = 'sp_%s' % state.savepoints
+            self._mark = len(state.invalidations)
+            await state.run(_execute, 'SAVEPOINT %s' % self._savepoint, ())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        state = self._state
+        if self._savepoint is not None:
+            if exc_type is None:
+                await state.run(_execute, 'RELEASE SAVEPOINT %s' % self._savepoint, ())
+            else:
+                await state.run(_execute, 'ROLLBACK TO SAVEPOINT %s' % self._savepoint, ())
+                # 回滚掉的插入删除已经算进行数里了
+                for model, primary_key in state.invalidations[self._mark:]:
+                    _row_counter.forget(model.__table__)
+            return False
+        _current_transaction.reset(self._token)
+        try:
+            if exc_type is None:
+                await state.conn.commit()
+            else:
+                await state.conn.rollback()
+        finally:
+            _primary_pool().release(state.conn)
+            for model, primary_key in state.invalidations:
+                model.invalidate_cache(primary_key)
+                if exc_type is not None:
+                    _row_counter.forget(model.__table__)
+        return False
+
+
+def transaction():
+    return Transaction()
+
+
+def _primary_pool():
+    return __pool
+
+
+@asyncio.coroutine
+def gather(*queries, max_concurrency=None):
+    """
+    Run independent queries concurrently, each on its own pooled connection
+
+    e.g.  blog, comments = yield from orm.gather(Blog.find_by_primary_key(blog_id),
+                                                 Comment.find_all(where='blog_id=?', args=[blog_id]))
+
+    At most max_concurrency queries run at the same time, by default half of the primary pool limit,
+    so one request can not take every connection. Inside a transaction there is only one connection
+    and the queries run one after another.
+
+    :return: a list of results in the order of queries
+    """
+    if in_transaction() or len(queries) <= 1:
+        results = []
+        try:
+            for query in queries:
+                results.append((yield from query))
+        finally:
+            # 出错时关掉还没运行的协程
+            for query in queries[len(results) + 1:]:
+                query.close()
+        return results
+    limit = max_concurrency or max(1, __pool.limit // 2)
+    semaphore = asyncio.Semaphore(limit)
+
+    @asyncio.coroutine
+    def run(query):
+        yield from semaphore.acquire()
+        try:
+            return (yield from query)
+        finally:
+            semaphore.release()
+    return (yield from asyncio.gather(*map(run, queries)))
+
+
+class IdGenerator(object):
+    """
+    k-sortable 64 bit ids: milliseconds since epoch (41 bits) | worker id (10 bits) | sequence (12 bits)
+
+    Ids of one process only increase: the sequence counts ids within the same millisecond, and when it
+    runs out or the clock goes back the generator keeps using (last millisecond + 1) until the clock catches up.
+    Different processes (or hosts) sharing a table need different worker ids.
+    """
+    EPOCH = 1420070400000  # 2015-01-01 00:00:00 UTC
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id < 1 << self.WORKER_BITS:
+            raise ValueError('[ORM]: worker_id must be in [0, %s)' % (1 << self.WORKER_BITS))
+        self.worker_id = worker_id
+        self._last = -1
+        self._sequence = 0
+
+    def next_id(self):
+        now = int(time.time() * 1000) - self.EPOCH
+        if now > self._last:
+            self._last, self._sequence = now, 0
+        else:
+            self._sequence += 1
+            if self._sequence >> self.SEQUENCE_BITS:
+                # 这一毫秒的序号用完了 借用下一毫秒 不sleep
+                self._last, self._sequence = self._last + 1, 0
+        return (self._last << (self.WORKER_BITS + self.SEQUENCE_BITS)) | \
+               (self.worker_id << self.SEQUENCE_BITS) | self._sequence
+
+
+_id_generator = IdGenerator(os.getpid() % (1 << IdGenerator.WORKER_BITS))
+_ID_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+_ID_LENGTH = 13  # 36 ** 13 > 2 ** 64
+
+
+def configure_id_generator(worker_id):
+    global _id_generator
+    _id_generator = IdGenerator(worker_id)
+
+
+def next_id():
+    """A new k-sortable 64 bit integer id, e.g. IdField(primary_key=True) uses it as the default"""
+    return _id_generator.next_id()
+
+
+def encode_id(number):
+    """
+    The fixed width base36 string form of an id, for urls, cookies and json (javascript numbers
+    can not hold 64 bit integers). Digits and lowercase letters only, so string order is id order
+    in case-insensitive collations too.
+    """
+    chars = []
+    for _ in range(_ID_LENGTH):
+        number, r = divmod(number, 36)
+        chars.append(_ID_ALPHABET[r])
+    if number:
+        raise ValueError('[ORM]: id out of range')
+    return ''.join(reversed(chars))
+
+
+def decode_id(s):
+    """Inverse of encode_id, raises ValueError on a malformed string"""
+    if not isinstance(s, str) or len(s) != _ID_LENGTH:
+        raise ValueError('[ORM]: Invalid id: %s' % s)
+    return int(s, 36)
+
+
+class Field(object):
+    # Abstract Class
+    def __init__(self, name, column_type, primary_key, default, index=False):
+        self.name = name
+        self.column_type = column_type
+        self.primary_key = primary_key
+        self.default = default
+        # True 普通索引, 'unique' 唯一索引
+        self.index = index
+
+    def __str__(self):
+        return 'Field Type: %s; Value Type: %s' % (self.__class__.__name__, self.column_type)
+
+
+class StringField(Field):
+    def __init__(self, name=None, column_type='varchar(100)', primary_key=False, default=None, index=False):
+        super(StringField, self).__init__(name, column_type, primary_key, default, index)
+
+
+class TextField(Field):
+    # This field will never be primary_key, so don't need to add primary_key parameter into __init__
+    def __init__(self, name=None, default=None, column_type='text'):
+        super(TextField, self).__init__(name, column_type, False, default)
+
+
+class CompressedText(object):
+    """
+    A compressed value loaded from a CompressedTextField, decompressed on first str()
+
+    Model objects replace it with the str when the field is read as an attribute (blog.content).
+    """
+    __slots__ = ('data', '_text')
+
+    def __init__(self, data):
+        self.data = data
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = zlib.decompress(self.data[1:]).decode('utf-8')
+        return self._text
+
+    def __eq__(self, other):
+        if isinstance(other, CompressedText):
+            return self.data == other.data
+        return str(self) == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompressedText(%s bytes)' % len(self.data)
+
+
+class CompressedTextField(Field):
+    """
+    Text stored zlib compressed in a blob column
+
+    Values of threshold bytes or more are compressed, smaller ones (or ones that do not get smaller) stay raw.
+    The first byte of the stored value is the flag: 0 raw utf8, 1 zlib.
+    Values without the flag (text read from a text column) are read as utf8 text.
+
+    Converting an existing text column, see migrations.py:
+        content = CompressedTextField(column_type='mediumtext', shadow='content_z')
+    writes the text into the field's own column and the compressed value into the nullable blob column shadow,
+    and reads the shadow column where it is set, so the old text column keeps working for code still reading it.
+    """
+    RAW = 0
+    ZLIB = 1
+
+    def __init__(self, name=None, default=None, column_type='mediumblob', threshold=1024, level=6,
+                 shadow=None, shadow_type='mediumblob'):
+        super(CompressedTextField, self).__init__(name, column_type, False, default)
+        self.threshold = threshold
+        self.level = level
+        self.shadow = shadow
+        self.shadow_type = shadow_type
+
+    def to_db(self, value):
+        if isinstance(value, CompressedText):
+            return value.data
+        data = value.encode('utf-8')
+        if len(data) >= self.threshold:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                return bytes((self.ZLIB,)) + compressed
+        return bytes((self.RAW,)) + data
+
+    def from_db(self, value):
+        if not isinstance(value, (bytes, bytearray)):
+            # 还是text列
+            return value
+        if value[:1] == bytes((self.ZLIB,)):
+            return CompressedText(bytes(value))
+        if value[:1] == bytes((self.RAW,)):
+            return value[1:].decode('utf-8')
+        return value.decode('utf-8')
+
+    def is_converted(self, value):
+        """Whether a stored value already has the flag byte"""
+        return isinstance(value, (bytes, bytearray)) and value[:1] in (bytes((self.RAW,)), bytes((self.ZLIB,)))
+
+
+def select_column(name, field):
+    """The select expression of a field: the column, or the shadow column falling back to the old one"""
+    shadow = getattr(field, 'shadow', None)
+    if shadow:
+        # 新列是blob 结果是二进制串 没回填的行读出来是没有flag的utf8
+        return 'COALESCE(`%s`, `%s`) `%s`' % (shadow, name, name)
+    return '`%s`' % name
+
+
+class BooleanField(Field):
+    def __init__(self, name=None, default=False, index=False):
+        super(BooleanField, self).__init__(name, 'boolean', False, default, index)
+
+
+class IntField(Field):
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super(IntField, self).__init__(name, 'bigint', primary_key, default, index)
+
+
+class FloatField(Field):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super(FloatField, self).__init__(name, 'real', primary_key, default, index)
+
+
+class VersionField(IntField):
+    """
+    Optimistic lock column. update_data only updates the row if its version is still the one loaded,
+    and increases it by one, otherwise raises StaleDataError.
+    """
+    def __init__(self, name=None, default=0):
+        super(VersionField, self).__init__(name, False, default)
+
+
+class IdField(Field):
+    """
+    BIGINT key filled by next_id(), 8 bytes in the clustered index and every secondary index.
+    Use encode_id/decode_id where the id leaves the server (urls, json).
+    """
+    def __init__(self, name=None, primary_key=False, default=next_id, index=False):
+        super(IdField, self).__init__(name, 'bigint', primary_key, default, index)
+
+
+class StaleDataError(RuntimeError):
+    """The row was changed (or deleted) by someone else since it was loaded"""
+    pass
+
+
+class Index(object):
+    """
+    An index on several columns, declared by __indexes__ = [Index('idx_created_at', 'created_at', 'id')]
+    Single column indexes can be declared by Field(index=True) instead.
+    """
+    def __init__(self, name, *columns, unique=False):
+        self.name = name
+        self.columns = columns
+        self.unique = unique
+
+
+class ForeignKey(StringField):
+    """
+    A column referencing the primary key of another model
+
+    e.g.  user_id = ForeignKey('User')  =>  Comment.find_all(select_related=['user']) sets comment.user
+    The relation name is the field name without _id unless relation is given.
+    """
+    def __init__(self, to, name=None, column_type='varchar(50)', relation=None, default=None, index=True):
+        # 默认建索引 按外键查询是最常见的用法
+        super(ForeignKey, self).__init__(name, column_type, False, default, index)
+        self.to = to
+        self.relation = relation
+
+
+class HasMany(object):
+    """
+    The rows of another model whose foreign key references this model. Not a column.
+
+    e.g.  comments = HasMany('Comment', foreign_key='blog_id', order_by='created_at DESC')
+          =>  Blog.find_all(prefetch=['comments']) sets blog.comments to a list
+    """
+    def __init__(self, to, foreign_key, order_by=None):
+        self.to = to
+        self.foreign_key = foreign_key
+        self.order_by = order_by
+
+
+# model name => model class, for resolving relations by name
+_models = {}
+
+
+def get_model(name):
+    try:
+        return _models[name]
+    except KeyError:
+        raise ValueError('[ORM]: Unknown model %s' % name)
+
+
+class RowCache(object):
+    """
+    LRU cache of rows keyed by primary key, with an expire time
+
+    Enabled on a model by __cache__ = dict(size=10000, ttl=60).
+    The cache only lives in this process, writes from other processes are only seen after ttl seconds.
+    """
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._rows = OrderedDict()  # primary key => (expire time, row)
+        # 每次失效都加一, 查询期间发生过写操作的结果不放进缓存
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        item = self._rows.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expire, row = item
+        if expire < time.time():
+            del self._rows[key]
+            self.misses += 1
+            return None
+        self._rows.move_to_end(key)
+        self.hits += 1
+        return row
+
+    def put(self, key, row, version, ttl=None):
+        if version != self.version:
+            return
+        self._rows[key] = (time.time() + (self.ttl if ttl is None else min(ttl, self.ttl)), row)
+        self._rows.move_to_end(key)
+        while len(self._rows) > self.size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.version += 1
+        self._rows.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._rows.clear()
+
+    def stats(self):
+        return dict(size=len(self._rows), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def match_key(key, column_type):
+    """
+    The key MySQL would compare with: numbers for integer columns ('1' = 1),
+    lower case without trailing spaces for strings (case-insensitive PAD SPACE collations)
+    """
+    if key is None:
+        return None
+    column_type = column_type.lower()
+    if 'int' in column_type:
+        try:
+            return int(key)
+        except (TypeError, ValueError):
+            return key
+    if 'char' in column_type or 'text' in column_type:
+        if isinstance(key, bytes):
+            key = key.decode('utf-8', 'replace')
+        return str(key).rstrip(' ').lower()
+    return key
+
+
+class BatchLoader(object):
+    """
+    Coalesces find_by_primary_key calls of one model into SELECT ... WHERE pk IN (...) queries
+
+    Primary keys requested within one event loop tick (or within window seconds) are deduplicated and
+    loaded with one query per max_batch keys, then every caller gets its row.
+    Configured on a model by __batch__ = dict(window=0.002, max_batch=500), __batch__ = None disables it.
+
+    :param column_type: column type of the primary key, rows are matched back to the keys the way MySQL compares them
+    """
+    def __init__(self, select_sql, primary_key, column_type='varchar(50)', window=0, max_batch=500):
+        self.select_sql = select_sql
+        self.primary_key = primary_key
+        self.column_type = column_type.lower()
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = OrderedDict()  # primary key => future
+        self._handle = None
+        self.batches = 0
+        self.keys = 0
+
+    @asyncio.coroutine
+    def load(self, primary_key):
+        """:return: the row dict of primary_key or None. The row is shared and must not be modified."""
+        future = self._pending.get(primary_key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self._pending[primary_key] = future
+            if len(self._pending) >= self.max_batch:
+                self._dispatch()
+            elif self._handle is None:
+                if self.window:
+                    self._handle = loop.call_later(self.window, self._dispatch)
+                else:
+                    self._handle = loop.call_soon(self._dispatch)
+        # 一个调用者被取消 不能影响同一批的其他调用者
+        return (yield from asyncio.shield(future))
+
+    def _dispatch(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        batch, self._pending = self._pending, OrderedDict()
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    @asyncio.coroutine
+    def _run(self, batch):
+        keys = list(batch)
+        self.batches += 1
+        self.keys += len(keys)
+        try:
+            rows = yield from select('%s WHERE `%s` IN (%s)' % (self.select_sql, self.primary_key,
+                                                                create_args_string(len(keys))), keys)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        found = {self.match_key(row[self.primary_key]): row for row in rows}
+        matched = {}
+        for key in keys:
+            row = found.get(self.match_key(key))
+            if row is not None:
+                matched[key] = row
+        # 有的行没对上任何主键: MySQL的比较规则和match_key不一样(e.g. 重音不敏感的collation) 没对上的主键单独查
+        if len({id(row) for row in matched.values()}) < len(rows):
+            for key in keys:
+                if key not in matched:
+                    try:
+                        single = yield from select('%s WHERE `%s`=?' % (self.select_sql, self.primary_key), [key], 1)
+                    except Exception as e:
+                        if not batch[key].done():
+                            batch[key].set_exception(e)
+                        continue
+                    if single:
+                        matched[key] = single[0]
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(matched.get(key))
+
+    def match_key(self, key):
+        return match_key(key, self.column_type)
+
+    def stats(self):
+        return dict(batches=self.batches, keys=self.keys, pending=len(self._pending))
+
+
+class QueryCache(object):
+    """
+    LRU cache of select results keyed by table version, sql and args, bounded by the approximate size of the rows
+
+    Every write through the ORM bumps the version of its table, so the cached queries of that table
+    are never hit again and age out of the LRU.
+    """
+    def __init__(self, max_bytes=0, ttl=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._results = OrderedDict()  # key => (expire time, size, rows)
+        self._table_versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def table_version(self, table):
+        return self._table_versions.get(table, 0)
+
+    def bump(self, table):
+        self._table_versions[table] = self.table_version(table) + 1
+
+    def key(self, table, sql, args, number=None):
+        return table, self.table_version(table), sql, tuple(args or ()), number
+
+    def get(self, key):
+        item = self._results.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expire, size, rows = item
+        if expire < time.time():
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return rows
+
+    def put(self, key, rows, ttl=None):
+        if key[1] != self.table_version(key[0]):
+            # 查询期间表被写过了
+            return
+        size = sys.getsizeof(rows)
+        for r in rows:
+            size += sys.getsizeof(r) + sum(map(sys.getsizeof, r.values() if isinstance(r, dict) else r))
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self._results[key] = (time.time() + (self.ttl if ttl is None else min(ttl, self.ttl)), size, rows)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._results)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        item = self._results.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def clear(self):
+        self._results.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return dict(size=len(self._results), bytes=self.bytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+_query_cache = QueryCache()
+
+
+def configure_query_cache(max_bytes, ttl=60):
+    """
+    Enable (max_bytes > 0) or disable the query result cache of find_all and count_rows
+
+    :param max_bytes: approximate memory limit of the cached rows
+    :param ttl: seconds a result stays valid, bounds how stale it is when other processes write the table
+    """
+    _query_cache.max_bytes = max_bytes
+    _query_cache.ttl = ttl
+    _query_cache.clear()
+
+
+def query_cache_stats():
+    return _query_cache.stats()
+
+
+@asyncio.coroutine
+def cached_select(table, sql, args=(), number=None, query_cache=True, tuples=False):
+    """select through the query result cache. The rows returned must not be modified."""
+    if not (query_cache and _query_cache.enabled) or in_transaction() or wrote_recently():
+        # 刚写过数据的请求要从主库读到自己写的 不能用缓存里的旧结果
+        return (yield from select(sql, args, number, tuples))
+    key = _query_cache.key(table, sql, args, (number, tuples))
+    rows = _query_cache.get(key)
+    if rows is None:
+        rows = yield from select(sql, args, number, tuples)
+        _query_cache.put(key, rows, replica_cache_ttl())
+    return rows
+
+
+class RowCounter(object):
+    """
+    Row counts of whole tables kept in memory
+
+    Inserts and deletes through the ORM adjust the counts incrementally, and a count older than
+    reconcile_interval seconds is queried again to pick up writes from other processes.
+    """
+    def __init__(self, reconcile_interval=300, approximate_threshold=1000000):
+        self.reconcile_interval = reconcile_interval
+        # information_schema的估计值超过这个数时 approximate=True 直接用估计值
+        self.approximate_threshold = approximate_threshold
+        self._counts = {}  # table => [count, reconciled at, estimate from information_schema]
+        self._versions = {}
+
+    def get(self, table):
+        item = self._counts.get(table)
+        if item is None or item[1] + self.reconcile_interval < time.time():
+            return None
+        return item[0]
+
+    def version(self, table):
+        return self._versions.get(table, 0)
+
+    def set(self, table, count, version, approximate=False):
+        # 查询期间有写操作的话 这个值可能已经不准了 下次再查一次
+        reconciled_at = time.time() if version == self.version(table) else 0
+        self._counts[table] = [count, reconciled_at, approximate]
+
+    def is_approximate(self, table):
+        item = self._counts.get(table)
+        return item is not None and item[2]
+
+    def forget(self, table):
+        self._versions[table] = self.version(table) + 1
+        self._counts.pop(table, None)
+
+    def adjust(self, table, delta):
+        self._versions[table] = self.version(table) + 1
+        item = self._counts.get(table)
+        if item is not None:
+            item[0] = max(item[0] + delta, 0)
+
+
+_row_counter = RowCounter()
+
+
+class WriteBuffer(object):
     """
-    logging.info('[DB]: Create database connecting pool')
-    global __pool
-    __pool = yield from aiomysql.create_pool(
-        host=kwargs.get('host', 'localhost'),
-        # 3306 is the default mysql port
-        port=kwargs.get('port', 3306),  # port is an integer
-        charset=kwargs.get('charset', 'utf8'),  # 尼玛为什么是utf8 No dash line ？？？
-        maxsize=kwargs.get('maxsize', 10),
-        minsize=kwargs.get('minsize', 1),
-        autocommit=kwargs.get('autocommit', True),
-        user=user,
-        password=password,
-        db=db,
-        loop=loop
-    )
+    Write-behind buffer of inserts, used by save(deferred=True)
 
+    Rows are buffered per model and written with one multi-row INSERT when max_rows rows are waiting or
+    delay seconds after the first one, so a burst of small inserts costs one commit instead of one each.
+    Every caller gets a future that is resolved once its row is committed. If a multi-row INSERT fails
+    its rows are inserted one by one, so only the bad rows get the exception.
+    """
+    def __init__(self, max_rows=500, delay=0.05):
+        self.max_rows = max_rows
+        self.delay = delay
+        self._pending = OrderedDict()  # model => [(instance, args, future)]
+        self._handles = {}
+        self._flushing = set()
+        self.flushes = 0
+        self.rows = 0
 
-@asyncio.coroutine
-def destroy_pool():  # 销毁连接池
-    global __pool
-    if __pool is not None:
-        __pool.close()
-        yield from __pool.wait_closed()
+    def add(self, instance):
+        """:return: a future resolved when the row is committed"""
+        model = type(instance)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # 参数在入队时取 之后对象再被修改也不影响写入的内容
+        pending = self._pending.setdefault(model, [])
+        pending.append((instance, instance.insert_args(), future))
+        if len(pending) >= self.max_rows:
+            self._dispatch(model)
+        elif model not in self._handles:
+            self._handles[model] = loop.call_later(self.delay, self._dispatch, model)
+        # 写入在别的task里执行 调用者这个请求之后的读操作也要走主库
+        _last_write.set(time.time())
+        return future
 
+    def _dispatch(self, model):
+        handle = self._handles.pop(model, None)
+        if handle is not None:
+            handle.cancel()
+        batch = self._pending.pop(model, None)
+        if batch:
+            task = asyncio.ensure_future(self._flush(model, batch))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
 
-@asyncio.coroutine
-def select(sql, args=(), number=None):
-    log(sql, args)
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        yield from cur.execute(sql.replace('?', '%s'), args)
-        res = yield from cur.fetchall()
-    print()
-    res = res[:number] if number else res
-    logging.info('[SQL]: %s row returned' % len(res))
-    return res
+    @asyncio.coroutine
+    def _flush(self, model, batch):
+        self.flushes += 1
+        args = []
+        for _, row_args, _ in batch:
+            args.extend(row_args)
+        try:
+            row_affected = yield from execute(model.__insert_many__ + ', '.join([model.__insert_row__] * len(batch)),
+                                              args)
+        except Exception as e:
+            logging.warning('[ORM]: Failed to flush %s rows into %s: %s, insert them one by one'
+                            % (len(batch), model.__table__, e))
+            for item in batch:
+                yield from self._flush_one(model, item)
+            return
+        _row_counter.adjust(model.__table__, row_affected)
+        for instance, _, future in batch:
+            self._done(model, instance, future)
 
-@asyncio.coroutine
-def execute(sql, args=()):
-    log(sql, args)
-    with (yield from __pool) as conn:
-        cur = yield from conn.cursor()
+    @asyncio.coroutine
+    def _flush_one(self, model, item):
+        instance, row_args, future = item
         try:
-            yield from cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount
-        except:
-            conn.rollback()
-            raise
-    return affected
+            row_affected = yield from execute(model.__insert__, row_args)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        _row_counter.adjust(model.__table__, row_affected)
+        self._done(model, instance, future)
 
+    def _done(self, model, instance, future):
+        self.rows += 1
+        model.invalidate_cache(instance[model.__primary_key__])
+        instance.mark_clean()
+        if not future.done():
+            future.set_result(True)
 
-class Field(object):
-    # Abstract Class
-    def __init__(self, name, column_type, primary_key, default):
-        self.name = name
-        self.column_type = column_type
-        self.primary_key = primary_key
-        self.default = default
+    @asyncio.coroutine
+    def drain(self):
+        """Flush every buffered row and wait until all of them are written"""
+        for model in list(self._pending):
+            self._dispatch(model)
+        while self._flushing:
+            yield from asyncio.wait(list(self._flushing))
 
-    def __str__(self):
-        return 'Field Type: %s; Value Type: %s' % (self.__class__.__name__, self.column_type)
+    def stats(self):
+        return dict(flushes=self.flushes, rows=self.rows,
+                    pending=sum(len(batch) for batch in self._pending.values()))
 
 
-class StringField(Field):
-    def __init__(self, name=None, column_type='varchar(100)', primary_key=False, default=None):
-        super(StringField, self).__init__(name, column_type, primary_key, default)
+_write_buffer = WriteBuffer()
 
 
-class TextField(Field):
-    # This field will never be primary_key, so don't need to add primary_key parameter into __init__
-    def __init__(self, name=None, default=None):
-        super(TextField, self).__init__(name, 'text', False, default)
+def configure_write_buffer(max_rows=500, delay=0.05):
+    _write_buffer.max_rows = max_rows
+    _write_buffer.delay = delay
 
 
-class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super(BooleanField, self).__init__(name, 'boolean', False, default)
+def write_buffer_stats():
+    return _write_buffer.stats()
 
 
-class IntField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super(IntField, self).__init__(name, 'bigint', primary_key, default)
+def _limit_args(limit, args):
+    """Append the args of limit (n or (offset, n)) to args, :return: the placeholders of the limit clause"""
+    if not limit:
+        return None
+    if isinstance(limit, int):
+        args.append(limit)
+        return '?'
+    if isinstance(limit, tuple) and len(limit) == 2:
+        args.extend(limit)
+        return '?, ?'
+    raise ValueError('Invalid limit value: %s' % str(limit))
 
 
-class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super(FloatField, self).__init__(name, 'real', primary_key, default)
+@functools.lru_cache(maxsize=256)
+def aggregate_tuple(name, columns):
+    """The namedtuple class of aggregate() results with these columns"""
+    return namedtuple(name, columns)
 
 
 def create_args_string(number):
@@ -121,6 +1548,267 @@ def create_args_string(number):
     return ', '.join(s)
 
 
+def create_table_sql(model, engine='innodb', charset='utf8'):
+    """
+    Build the CREATE TABLE statement of a model, including its primary key and indexes
+
+    e.g.  print(create_table_sql(Blog))
+    """
+    lines = ['    `%s` %s not null' % (f, model.__mappings__[f].column_type)
+             for f in [model.__primary_key__] + model.__fields__]
+    lines.extend('    `%s` %s' % (shadow, model.__mappings__[f].shadow_type) for f, shadow in model.__shadows__.items())
+    for index in model.__indexes__:
+        lines.append('    %skey `%s` (%s)' % ('unique ' if index.unique else '', index.name,
+                                             ', '.join(map(lambda c: '`%s`' % c, index.columns))))
+    lines.append('    primary key (`%s`)' % model.__primary_key__)
+    return 'create table `%s` (\n%s\n) engine=%s default charset=%s;' % \
+           (model.__table__, ',\n'.join(lines), engine, charset)
+
+
+def create_index_sql(model):
+    """Build CREATE INDEX statements of a model, for adding the declared indexes to an existing table"""
+    return ['create %sindex `%s` on `%s` (%s);' % ('unique ' if index.unique else '', index.name, model.__table__,
+                                                  ', '.join(map(lambda c: '`%s`' % c, index.columns)))
+            for index in model.__indexes__]
+
+
+class QueryPlanChecker(object):
+    """
+    Runs EXPLAIN once for every distinct select statement and records plans that scan the whole table
+    (type ALL) or sort in a file, when MySQL estimates more than max_rows rows.
+
+    Enabled by orm.enable_plan_checker(), meant for the test suite and staging.
+    """
+    def __init__(self, max_rows=1000):
+        self.max_rows = max_rows
+        self.checked = set()
+        self.problems = []
+
+    @asyncio.coroutine
+    def check(self, sql, args):
+        if sql in self.checked or not sql.lstrip().upper().startswith('SELECT'):
+            return
+        self.checked.add(sql)
+        tx = _current_transaction.get()
+        explain = 'EXPLAIN %s' % sql
+        if tx is not None:
+            plans = yield from tx.run(_fetch, explain, args, None)
+        else:
+            plans = yield from _select(_primary_pool(), explain, args, None)
+        for plan in plans:
+            rows = plan.get('rows') or 0
+            extra = plan.get('Extra') or ''
+            if rows <= self.max_rows:
+                continue
+            if plan.get('type') == 'ALL' or 'filesort' in extra:
+                problem = dict(sql=sql, table=plan.get('table'), type=plan.get('type'), rows=rows, extra=extra)
+                logging.warning('[ORM]: Slow query plan: %s' % problem)
+                self.problems.append(problem)
+
+
+_plan_checker = None
+
+
+def enable_plan_checker(max_rows=1000):
+    global _plan_checker
+    _plan_checker = QueryPlanChecker(max_rows)
+    return _plan_checker
+
+
+def disable_plan_checker():
+    global _plan_checker
+    _plan_checker = None
+
+
+class Row(object):
+    """
+    Base class of the compact read-only rows returned by find_all(as_rows=True)
+
+    Each model generates a subclass per selected column list, with __slots__ instead of a dict per row,
+    built straight from the tuples of a plain cursor. Attribute access works in templates, and
+    response_factory turns rows into json objects by _asdict().
+    """
+    __slots__ = ()
+    _fields = ()
+    __model__ = None
+
+    def _asdict(self):
+        return {f: getattr(self, f) for f in self._fields}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_model(self):
+        """A full model object of this row, e.g. to modify and update_data() it"""
+        return self.__model__.from_row(self._asdict(), self.__model__.projection(columns=self._fields)[1])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self._fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (f, getattr(self, f)) for f in self._fields))
+
+
+def make_row_class(model, columns):
+    """Generate a Row subclass whose __init__ takes the columns positionally, in select order"""
+    namespace = {}
+    # 和dataclass一样生成__init__ 构造时不需要经过kwargs
+    # 压缩过的field在构造时就解压 Row是只读的 没有地方延迟
+    lines = []
+    for c in columns:
+        if c in model.__converted__:
+            namespace['_from_db_%s' % c] = model.__converted__[c].from_db
+            lines.append('    self.%s = %s if %s is None else str(_from_db_%s(%s))\n' % (c, c, c, c, c))
+        else:
+            lines.append('    self.%s = %s\n' % (c, c))
+    source = 'def __init__(self, %s):\n%s' % (', '.join(columns), ''.join(lines))
+    exec(source, namespace)
+    return type('%sRow' % model.__name__, (Row,), dict(
+        __slots__=tuple(columns),
+        __init__=namespace['__init__'],
+        _fields=tuple(columns),
+        __model__=model
+    ))
+
+
+class QuerySet(object):
+    """
+    Lazy chainable query of a model, built by Model.query()
+
+    Every call returns a new QuerySet, nothing is sent to the database until it is awaited or iterated.
+    The statement is built by Model.build_find_sql, so each shape is compiled to sql only once.
+
+    e.g.  blogs = yield from Blog.query().where('user_id=?', uid).order_by('created_at desc')[0:10]
+          async for blog in Blog.query().defer('content'):
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._where = []
+        self._args = []
+        self._kwargs = {}
+        self._limit = None
+        self._offset = None
+
+    def _clone(self, **kwargs):
+        qs = QuerySet(self.model)
+        qs._where = list(self._where)
+        qs._args = list(self._args)
+        qs._kwargs = dict(self._kwargs, **kwargs)
+        qs._limit = self._limit
+        qs._offset = self._offset
+        return qs
+
+    def where(self, clause, *args):
+        """Add a condition, several conditions are joined by AND"""
+        qs = self._clone()
+        qs._where.append(clause)
+        qs._args.extend(args)
+        return qs
+
+    def order_by(self, *columns):
+        return self._clone(order_by=', '.join(columns))
+
+    def only(self, *columns):
+        return self._clone(columns=columns)
+
+    def defer(self, *fields):
+        return self._clone(defer=fields)
+
+    def rows(self):
+        """Return compact read-only Row objects, see find_all(as_rows=True)"""
+        return self._clone(as_rows=True)
+
+    def after(self, value, primary_key, keyset='created_at'):
+        return self._clone(after=(value, primary_key), keyset=keyset)
+
+    def before(self, value, primary_key, keyset='created_at'):
+        return self._clone(before=(value, primary_key), keyset=keyset)
+
+    def select_related(self, *relations):
+        return self._clone(select_related=relations)
+
+    def prefetch(self, *relations):
+        return self._clone(prefetch=relations)
+
+    def limit(self, number):
+        qs = self._clone()
+        qs._limit = number
+        return qs
+
+    def offset(self, number):
+        qs = self._clone()
+        qs._offset = number
+        return qs
+
+    def __getitem__(self, key):
+        # 只支持切片 query()[10:20] 对应 limit 10, 10
+        if not isinstance(key, slice) or key.step is not None:
+            raise ValueError('[ORM]: QuerySet only supports slices without step')
+        start = key.start or 0
+        if start < 0 or (key.stop is not None and key.stop < start):
+            raise ValueError('[ORM]: Invalid slice: %s' % str(key))
+        qs = self._clone()
+        qs._offset = start or None
+        qs._limit = key.stop - start if key.stop is not None else None
+        return qs
+
+    def find_kwargs(self):
+        """The arguments of find_all / iter_all this query stands for"""
+        kwargs = dict(self._kwargs)
+        if self._where:
+            kwargs['where'] = ' AND '.join('(%s)' % w for w in self._where) if len(self._where) > 1 \
+                else self._where[0]
+            kwargs['args'] = list(self._args)
+        if self._offset:
+            # mysql的offset必须和limit一起用 没有limit时用文档里的最大值
+            kwargs['limit'] = (self._offset, self._limit if self._limit is not None else 18446744073709551615)
+        elif self._limit is not None:
+            kwargs['limit'] = self._limit
+        return kwargs
+
+    @asyncio.coroutine
+    def all(self, query_cache=True):
+        if self._limit == 0:
+            return []
+        return (yield from self.model.find_all(query_cache=query_cache, **self.find_kwargs()))
+
+    @asyncio.coroutine
+    def first(self):
+        qs = self._clone()
+        qs._limit = 1
+        results = yield from qs.all()
+        return results[0] if results else None
+
+    @asyncio.coroutine
+    def count(self):
+        """Number of rows matching the conditions, limit and order are ignored"""
+        return (yield from self.model.count_rows(where=' AND '.join('(%s)' % w for w in self._where) or None,
+                                                 args=list(self._args)))
+
+    def __await__(self):
+        return (yield from self.all())
+
+    # 和asyncio.Future一样 @asyncio.coroutine里可以yield from
+    __iter__ = __await__
+
+    async def __aiter__(self):
+        if self._limit == 0:
+            return
+        async for obj in self.model.iter_all(**self.find_kwargs()):
+            yield obj
+
+    def __repr__(self):
+        sql, args = self.model.build_find_sql(**self.find_kwargs())
+        return '<QuerySet %s %s>' % (sql, args)
+
+
 class MetaModel(type):
 
     def __new__(mcs, future_class_name, future_class_parents, future_class_attributes):
@@ -141,10 +1829,17 @@ class MetaModel(type):
         logging.info('[ORM]: Found model: %s [table name: %s]' % (future_class_name, table_name))
 
         mappings = {}
+        # relation name => ForeignKey field name or HasMany
+        relations = {}
         # fields contains all fields except primary key field
         fields = []
         found_primary_key = False
         for key, value in future_class_attributes.items():
+            if isinstance(value, HasMany):
+                relations[key] = value
+            if isinstance(value, ForeignKey):
+                relation = value.relation or (key[:-3] if key.endswith('_id') else '%s_object' % key)
+                relations[relation] = key
             if isinstance(value, Field):
                 # e.g  key = 'email'; value = StringField(column_type='varchar(50)')
                 logging.info('[ORM]: Found mapping %s => %s' % (key, value))
@@ -157,21 +1852,34 @@ class MetaModel(type):
                     fields.append(key)
         if not found_primary_key:
             raise RuntimeError('[ORM]: Did not found primary key.')
+        version_fields = [k for k, v in mappings.items() if isinstance(v, VersionField)]
+        if len(version_fields) > 1:
+            raise RuntimeError('[ORM]: Duplicated version field.')
 
         for field_name in mappings:
             # 把attr里面的field项都清理掉 包括primary_key
             future_class_attributes.pop(field_name)
+        for relation in relations.values():
+            if isinstance(relation, HasMany):
+                future_class_attributes.pop(next(k for k, v in future_class_attributes.items() if v is relation))
 
         # 重写类的attributes
         primary_key = found_primary_key
         # 不知道是干嘛的。。。 详细看了mysql的sql语句应该就明白了 暂时掠过
         # Maybe to defence SQL injection attack
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
+        # field name => 转换期间同时写入的新列, e.g. CompressedTextField(shadow='content_z')
+        shadows = OrderedDict((f, mappings[f].shadow) for f in fields if getattr(mappings[f], 'shadow', None))
+        insert_fields = escaped_fields + ['`%s`' % shadow for shadow in shadows.values()]
 
         # sql statements
-        sql_select = 'SELECT `%s`, %s from `%s`' % (primary_key, ', '.join(escaped_fields), table_name)
+        sql_select = 'SELECT `%s`, %s from `%s`' % \
+                     (primary_key, ', '.join(select_column(f, mappings[f]) for f in fields), table_name)
         sql_insert = 'INSERT INTO `%s` (`%s`, %s) values (%s)' % \
-                     (table_name, primary_key, ', '.join(escaped_fields), create_args_string(len(escaped_fields) + 1))
+                     (table_name, primary_key, ', '.join(insert_fields), create_args_string(len(insert_fields) + 1))
+        # save_many 用: 'INSERT INTO ... values ' + 'n组(?, ?, ...)'
+        sql_insert_many = sql_insert[:sql_insert.rindex('(')]
+        sql_insert_row = '(%s)' % create_args_string(len(insert_fields) + 1)
         sql_delete = 'DELETE FROM `%s` WHERE `%s`=?' % (table_name, primary_key)
 
         # 貌似用不到Field示例的name属性 所以我就不按着这个写了
@@ -183,32 +1891,86 @@ class MetaModel(type):
                       primary_key)
         # e.g 'UPDATE `%s` SET `email`=?, `name`=? (...省略) WHERE `id`=?'
 
+        cache_config = future_class_attributes.get('__cache__', None)
+        row_cache = RowCache(**cache_config) if cache_config else None
+        # 默认开启 合并同一个tick里的主键查询
+        batch_config = future_class_attributes.get('__batch__', {})
+        batch_loader = BatchLoader(sql_select, primary_key, mappings[primary_key].column_type,
+                                   **batch_config) if batch_config is not None else None
+
         future_class_attributes.update(
+            __row_cache__=row_cache,
+            __batch_loader__=batch_loader,
+            __relations__=relations,
+            __row_classes__={},
+            # 读写时要转换值的field, e.g. CompressedTextField
+            __converted__={k: v for k, v in mappings.items() if isinstance(v, CompressedTextField)},
+            __shadows__=shadows,
+            __version_field__=version_fields[0] if version_fields else None,
             __mappings__=mappings,
             __table__=table_name,
             __primary_key__=primary_key,
             __fields__=fields,
             __select__=sql_select,
             __insert__=sql_insert,
+            __insert_many__=sql_insert_many,
+            __insert_row__=sql_insert_row,
             __delete__=sql_delete,
             __update__=sql_update
         )
 
-        return type.__new__(mcs, future_class_name, future_class_parents, future_class_attributes)
+        indexes = list(future_class_attributes.get('__indexes__', ()))
+        for field_name in fields:
+            index = mappings[field_name].index
+            if index:
+                indexes.append(Index('idx_%s' % field_name, field_name, unique=index == 'unique'))
+        future_class_attributes['__indexes__'] = indexes
+
+        model = type.__new__(mcs, future_class_name, future_class_parents, future_class_attributes)
+        _models[future_class_name] = model
+        return model
 
 
 class Model(dict, metaclass=MetaModel):
     """Abstract class"""
+    # 查询时没有select的field, 实例会用object.__setattr__覆盖这个值
+    __deferred__ = frozenset()
+    # 从数据库加载之后被修改过的field; None表示不是加载出来的实例, update_data写它拥有的所有field
+    __dirty__ = None
+
     def __getattr__(self, key):
         # 只有在访问该类实例拥有的方法时调用
         try:
-            return self[key]
+            value = self[key]
         except KeyError:
+            if key in self.__deferred__:
+                raise AttributeError('[ORM]: %s is deferred, call load_deferred() first' % key)
             raise AttributeError('[ORM]: The model don\'t have %s attribute' % key)
+        if type(value) is CompressedText:
+            # 第一次访问时才解压 换成str 不算修改
+            value = str(value)
+            dict.__setitem__(self, key, value)
+        return value
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    def __setitem__(self, key, value):
+        dirty = self.__dirty__
+        if dirty is not None and key in self.__mappings__ and (key not in self or self[key] != value):
+            dirty.add(key)
+        super(Model, self).__setitem__(key, value)
+
+    def mark_clean(self):
+        """Start tracking changes from the current values"""
+        object.__setattr__(self, '__dirty__', set())
+
+    def changed_fields(self):
+        """:return: names of the fields update_data would write"""
+        if self.__dirty__ is None:
+            return [f for f in self.__fields__ if f in self]
+        return [f for f in self.__fields__ if f in self.__dirty__]
+
     def get_value_or_default(self, field_name):
         value = self.get(field_name, None)
         # 如果实例并没有写这个field的值 则用default处理
@@ -221,86 +1983,618 @@ class Model(dict, metaclass=MetaModel):
                 self[field_name] = value
         return value
 
+    def db_value(self, field_name):
+        """The value written into the column of field_name"""
+        value = self.get_value_or_default(field_name)
+        field = self.__converted__.get(field_name)
+        if field is not None and value is not None:
+            # 有shadow列时 原来的text列还是写文本
+            return str(value) if field.shadow else field.to_db(value)
+        return value
+
+    def shadow_value(self, field_name):
+        """The value written into the shadow column of field_name"""
+        value = self.get_value_or_default(field_name)
+        return None if value is None else self.__converted__[field_name].to_db(value)
+
     @classmethod
-    @asyncio.coroutine
-    def find_all(cls, args=None, where=None, **kwargs):
+    def from_row(cls, row, deferred=frozenset()):
+        instance = cls(**row)
+        cls.convert_from_db(instance)
+        instance.mark_clean()
+        if deferred:
+            object.__setattr__(instance, '__deferred__', deferred)
+        return instance
+
+    @classmethod
+    def convert_from_db(cls, values):
+        for field_name, field in cls.__converted__.items():
+            value = values.get(field_name)
+            if value is not None:
+                dict.__setitem__(values, field_name, field.from_db(value))
+
+    @classmethod
+    def row_class(cls, deferred=frozenset()):
+        """The Row class of a projection, generated once per deferred field set"""
+        row_class = cls.__row_classes__.get(deferred)
+        if row_class is None:
+            columns = [cls.__primary_key__] + [f for f in cls.__fields__ if f not in deferred]
+            row_class = cls.__row_classes__[deferred] = make_row_class(cls, columns)
+        return row_class
+
+    @classmethod
+    def projection(cls, columns=None, defer=None):
         """
-        Find objects by where clause
+        Get the select clause and the deferred fields of a query
 
-        :return a list of object
+        :param columns: only select these fields (primary key is always selected)
+        :param defer: select every field except these
+        :return: (select sql, frozenset of deferred field names)
+        """
+        if not columns and not defer:
+            return cls.__select__, frozenset()
+        # 每种columns/defer组合只拼一次 find_all/iter_all每次都要用到deferred
+        return cls.compile_projection(tuple(columns) if columns else None, tuple(defer) if defer else None)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def compile_projection(cls, columns, defer):
+        selected = set(columns or cls.__fields__) - set(defer or ())
+        for field_name in selected | set(defer or ()):
+            if field_name not in cls.__mappings__:
+                raise ValueError('[ORM]: The model don\'t have %s field' % field_name)
+        fields = [f for f in cls.__fields__ if f in selected]
+        deferred = frozenset(f for f in cls.__fields__ if f not in selected)
+        sql = 'SELECT `%s`, %s from `%s`' % \
+              (cls.__primary_key__, ', '.join(select_column(f, cls.__mappings__[f]) for f in fields), cls.__table__)
+        return sql, deferred
+
+    @classmethod
+    def query(cls):
+        """A lazy chainable QuerySet of this model, see QuerySet"""
+        return QuerySet(cls)
+
+    @classmethod
+    def build_find_sql(cls, where=None, args=None, **kwargs):
         """
-        sql = [cls.__select__]
+        Build the select statement used by find_all and iter_all
+
+        The statement of each query shape (where clause, order, limit form, projection, keyset direction)
+        is compiled once by compile_find_sql, only the args are collected on every call.
+
+        :return: (sql, args)
+        """
+        # sql的args必须传入iterable object， 且默认参数不要设置为mutable object
+        # 复制一份 避免把limit的参数加到调用者的list里
+        args = list(args) if args else []
+
+        after = kwargs.get('after', None)
+        before = kwargs.get('before', None)
+        if after and before:
+            raise ValueError('[ORM]: after and before can not be used together')
+        if after or before:
+            value, primary_key = after or before
+            args.extend([value, value, value, primary_key])
+
+        limit_form = _limit_args(kwargs.get('limit', None), args)
+        columns = kwargs.get('columns', None)
+        defer = kwargs.get('defer', None)
+        sql = cls.compile_find_sql(where or None, kwargs.get('order_by', None) or None, limit_form,
+                                   tuple(columns) if columns else None, tuple(defer) if defer else None,
+                                   'after' if after else 'before' if before else None,
+                                   kwargs.get('keyset', 'created_at'))
+        return sql, args
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def compile_find_sql(cls, where, order_by, limit_form, columns, defer, direction, keyset):
+        sql = [cls.projection(columns, defer)[0]]
+
+        if direction:
+            # keyset分页: 按(keyset, 主键)倒序, after取这个位置之后的一页, before取之前的一页
+            # 走keyset列上的索引 不需要扫描并丢弃offset行
+            if order_by:
+                raise ValueError('[ORM]: after/before can not be used with order_by')
+            op = '<' if direction == 'after' else '>'
+            keyset_where = '`{k}` {op}= ? AND (`{k}` {op} ? OR (`{k}` = ? AND `{pk}` {op} ?))'.format(
+                k=keyset, pk=cls.__primary_key__, op=op)
+            where = '(%s) AND %s' % (where, keyset_where) if where else keyset_where
+            order_by = '`{k}` {d}, `{pk}` {d}'.format(k=keyset, pk=cls.__primary_key__,
+                                                     d='DESC' if direction == 'after' else 'ASC')
+
         if where:
             sql.append('WHERE')
             sql.append(where)
 
-        if not args:
-            # sql的args必须传入iterable object， 且默认参数不要设置为mutable object
-            # 因此有这一步
-            args = []
-
-        order_by = kwargs.get('order_by', None)
         if order_by:
             sql.append('ORDER BY')
             sql.append(order_by)
 
-        limit = kwargs.get('limit', None)
-        if limit:
+        if limit_form:
             sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple):
-                if len(limit) == 2:
-                    sql.append('?, ?')
-                    args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        result = yield from select(' '.join(sql), args)
+            sql.append(limit_form)
+        return ' '.join(sql)
+
+    @classmethod
+    @asyncio.coroutine
+    def find_all(cls, args=None, where=None, query_cache=True, **kwargs):
+        """
+        Find objects by where clause
+
+        e.g.  Blog.find_all(defer=['content']) or Blog.find_all(columns=['name', 'summary'])
+        Fields not selected are deferred and can be loaded later by load_deferred().
+
+        as_rows=True returns compact read-only Row objects built from plain tuples instead of model objects,
+        for read only listings.
+
+        Keyset pagination: Blog.find_all(after=(created_at, id), limit=10) returns the next page in
+        (created_at DESC, id DESC) order, before=(created_at, id) the previous one in the same order.
+        keyset='column' changes the sort column.
+
+        :param query_cache: False to skip the query result cache
+        :return a list of object
+        """
+        sql, args = cls.build_find_sql(where, args, **kwargs)
+        deferred = cls.projection(kwargs.get('columns', None), kwargs.get('defer', None))[1]
+        relations = list(kwargs.get('select_related', None) or ()) + list(kwargs.get('prefetch', None) or ())
+        as_rows = kwargs.get('as_rows', False)
+        if as_rows and relations:
+            raise ValueError('[ORM]: Relations can not be loaded into rows')
+        result = yield from cached_select(cls.__table__, sql, args, query_cache=query_cache, tuples=as_rows)
+        if kwargs.get('before', None):
+            # before是按正序查出来的 反过来和after保持同样的顺序
+            result = result[::-1]
+        if as_rows:
+            row_class = cls.row_class(deferred)
+            return [row_class(*r) for r in result]
         # 返回结果result 是字典变量 传关键字参数进去构造当前类的实例！ 好巧妙
-        return [cls(**r) for r in result]
+        instances = [cls.from_row(r, deferred) for r in result]
+        if relations:
+            yield from cls.load_related(instances, relations)
+        return instances
+
+    @classmethod
+    @asyncio.coroutine
+    def load_related(cls, instances, relations, chunk_size=1000):
+        """
+        Load relations of objects with one IN query per relation (per chunk_size keys)
+
+        A ForeignKey relation sets the related object (or None), a HasMany relation sets a list.
+        They are set as plain attributes, not dict items, so they are not written back or dumped into json.
+
+        e.g.  yield from Comment.load_related(comments, ['user'])
+        """
+        for name in relations:
+            relation = cls.__relations__.get(name, None)
+            if relation is None:
+                raise ValueError('[ORM]: The model don\'t have %s relation' % name)
+            if isinstance(relation, HasMany):
+                target = get_model(relation.to)
+                key_field, match_field = cls.__primary_key__, relation.foreign_key
+            else:
+                target = get_model(cls.__mappings__[relation].to)
+                key_field, match_field = relation, target.__primary_key__
+            keys = list(OrderedDict.fromkeys(i[key_field] for i in instances if i.get(key_field) is not None))
+            related = []
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                related.extend((yield from target.find_all(
+                    where='`%s` IN (%s)' % (match_field, create_args_string(len(chunk))), args=chunk,
+                    order_by=relation.order_by if isinstance(relation, HasMany) else None)))
+            if isinstance(relation, HasMany):
+                groups = {}
+                for r in related:
+                    groups.setdefault(r[match_field], []).append(r)
+                for i in instances:
+                    object.__setattr__(i, name, groups.get(i[key_field], []))
+            else:
+                found = {r[match_field]: r for r in related}
+                for i in instances:
+                    object.__setattr__(i, name, found.get(i.get(key_field)))
+
+    @classmethod
+    async def iter_all(cls, args=None, where=None, chunk_size=500, **kwargs):
+        """
+        Iterate over objects by where clause without loading the whole result set
+
+        e.g.  async for blog in Blog.iter_all(where='user_id=?', args=[uid], chunk_size=500):
+
+        :param chunk_size: number of rows fetched from the server per round trip
+        :return an async iterator of object
+        """
+        if kwargs.get('before', None):
+            raise ValueError('[ORM]: iter_all does not support before, use after')
+        sql, args = cls.build_find_sql(where, args, **kwargs)
+        deferred = cls.projection(kwargs.get('columns', None), kwargs.get('defer', None))[1]
+        if kwargs.get('as_rows', False):
+            row_class = cls.row_class(deferred)
+            async for rows in select_iter(sql, args, chunk_size, tuples=True):
+                for r in rows:
+                    yield row_class(*r)
+            return
+        async for rows in select_iter(sql, args, chunk_size):
+            for r in rows:
+                yield cls.from_row(r, deferred)
 
     @classmethod
     @asyncio.coroutine
-    def count_rows(cls, select_field='*', where=None, args=None):
-        """ find number by select and where. """
+    def count_rows(cls, select_field='*', where=None, args=None, query_cache=True, cached=False, approximate=False):
+        """
+        find number by select and where.
+
+        :param cached: use the row count of the whole table kept in memory, query only when it is missing or old
+        :param approximate: like cached, but use the estimate in information_schema for very large tables
+        """
+        if cached or approximate:
+            if where:
+                raise ValueError('[ORM]: cached/approximate count only works for the whole table')
+            return (yield from cls.cached_count(approximate))
         sql = ['select count(%s) _num_ from `%s`' % (select_field, cls.__table__)]
         if where:
             sql.append('where %s' % where)
-        results = yield from select(' '.join(sql), args, 1)  # size = 1
+        results = yield from cached_select(cls.__table__, ' '.join(sql), args, 1, query_cache)  # size = 1
         if not results:
             return 0
         return results[0].get('_num_', 0)
 
+    @classmethod
+    @asyncio.coroutine
+    def aggregate(cls, group_by=None, count=None, min=None, max=None, sum=None, where=None, args=None,
+                  order_by=None, limit=None, query_cache=True):
+        """
+        GROUP BY query returning named tuples, one per group
+
+        e.g.  Comment.aggregate(group_by='blog_id', count='*', max='created_at')
+              => [CommentAggregate(blog_id='...', count=3, max_created_at=1463816123.2), ...]
+              Blog.aggregate(group_by=[('year', 'YEAR(FROM_UNIXTIME(`created_at`))')], count='*', order_by='year')
+
+        :param group_by: field names, or (name, sql expression) pairs
+        :param count: '*' (column count) or field names (columns count_<field>)
+        :param min: field names, columns min_<field>, same for max and sum
+        :param query_cache: False to skip the query result cache
+        :return: a list of named tuples
+        """
+        groups = []
+        for item in ([group_by] if isinstance(group_by, (str, tuple)) else list(group_by or ())):
+            if isinstance(item, tuple):
+                groups.append(item)
+                continue
+            if item not in cls.__mappings__:
+                raise ValueError('[ORM]: The model don\'t have %s field' % item)
+            groups.append((item, '`%s`' % item))
+        aggregates = []
+        for func, field_names in (('count', count), ('min', min), ('max', max), ('sum', sum)):
+            for field_name in ([field_names] if isinstance(field_names, str) else list(field_names or ())):
+                if not (field_name in cls.__mappings__ or field_name == '*' and func == 'count'):
+                    raise ValueError('[ORM]: The model don\'t have %s field' % field_name)
+                aggregates.append((func, field_name))
+        if not aggregates:
+            raise ValueError('[ORM]: aggregate needs count, min, max or sum')
+        args = list(args) if args else []
+        limit_form = _limit_args(limit, args)
+        sql, columns = cls.compile_aggregate_sql(tuple(groups), tuple(aggregates), where, order_by, limit_form)
+        result = yield from cached_select(cls.__table__, sql, args, query_cache=query_cache, tuples=True)
+        row_type = aggregate_tuple('%sAggregate' % cls.__name__, columns)
+        return [row_type._make(r) for r in result]
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def compile_aggregate_sql(cls, groups, aggregates, where, order_by, limit_form):
+        selected = ['%s `%s`' % (expression, name) for name, expression in groups]
+        columns = [name for name, _ in groups]
+        for func, field_name in aggregates:
+            name = func if field_name == '*' else '%s_%s' % (func, field_name)
+            selected.append('%s(%s) `%s`' % (func.upper(), '*' if field_name == '*' else '`%s`' % field_name, name))
+            columns.append(name)
+        sql = ['SELECT %s FROM `%s`' % (', '.join(selected), cls.__table__)]
+        if where:
+            sql.append('WHERE %s' % where)
+        if groups:
+            sql.append('GROUP BY %s' % ', '.join('`%s`' % name for name, _ in groups))
+        if order_by:
+            sql.append('ORDER BY %s' % order_by)
+        if limit_form:
+            sql.append('LIMIT %s' % limit_form)
+        return ' '.join(sql), tuple(columns)
+
+    @classmethod
+    @asyncio.coroutine
+    def cached_count(cls, approximate=False):
+        if in_transaction():
+            # 事务里的行数别人看不到 不能放进内存
+            return (yield from cls.count_rows(query_cache=False))
+        count = _row_counter.get(cls.__table__)
+        # 估计值只给approximate=True的调用者 要精确值的重新count一次
+        if count is not None and (approximate or not _row_counter.is_approximate(cls.__table__)):
+            return count
+        version = _row_counter.version(cls.__table__)
+        if approximate:
+            results = yield from select(
+                'SELECT TABLE_ROWS _num_ FROM information_schema.TABLES '
+                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?', [cls.__table__], 1)
+            estimate = results[0]['_num_'] if results else None
+            if estimate is not None and estimate > _row_counter.approximate_threshold:
+                # 大表上count(*)要扫描整个索引 直接用估计值
+                _row_counter.set(cls.__table__, estimate, version, approximate=True)
+                return estimate
+        count = yield from cls.count_rows(query_cache=False)
+        _row_counter.set(cls.__table__, count, version)
+        return count
+
+    @classmethod
+    def count_is_approximate(cls):
+        """Whether the last cached_count(approximate=True) of this table returned the information_schema estimate"""
+        return _row_counter.is_approximate(cls.__table__)
+
     @classmethod
     @asyncio.coroutine
     def find_by_primary_key(cls, primary_key):
-        result = yield from select('%s WHERE `%s`=?' % (cls.__select__, cls.__primary_key__), [primary_key], 1)
-        if len(result) == 0:
+        cache = cls.__row_cache__
+        # 事务里和刚写过数据的请求 要用自己的连接或主库读 也不能用缓存里的旧行
+        primary = in_transaction() or wrote_recently()
+        if cache is not None:
+            if not primary:
+                # /blog/ABC和/blog/abc是同一行 缓存里只有一份 失效时才能清干净
+                row = cache.get(cls.cache_key(primary_key))
+                if row is not None:
+                    # 返回副本 调用者修改实例不会影响缓存
+                    return cls.from_row(row)
+            version = cache.version
+        if cls.__batch_loader__ is None or primary:
+            result = yield from select('%s WHERE `%s`=?' % (cls.__select__, cls.__primary_key__), [primary_key], 1)
+            row = result[0] if result else None
+        else:
+            row = yield from cls.__batch_loader__.load(primary_key)
+        if row is None:
             return None
-        return cls(**result[0])
+        if cache is not None and not in_transaction():
+            # 事务里读到的可能是没提交的数据; 副本上读到的可能是旧的 只缓存副本可能落后的那么久
+            cache.put(cls.cache_key(row[cls.__primary_key__]), row, version, None if primary else replica_cache_ttl())
+        return cls.from_row(row)
+
+    @classmethod
+    def cache_key(cls, primary_key):
+        """The row cache key of a primary key, the same for every spelling MySQL treats as equal"""
+        return match_key(primary_key, cls.__mappings__[cls.__primary_key__].column_type)
+
+    @classmethod
+    def cache_stats(cls):
+        """hit/miss/eviction counters of the primary key row cache, None if the cache is not enabled"""
+        return cls.__row_cache__.stats() if cls.__row_cache__ is not None else None
+
+    @classmethod
+    def invalidate_cache(cls, primary_key=None):
+        """Called after every write: bumps the table version of the query cache and drops cached rows"""
+        tx = _current_transaction.get()
+        if tx is not None:
+            tx.invalidations.append((cls, primary_key))
+        _query_cache.bump(cls.__table__)
+        if cls.__row_cache__ is None:
+            return
+        if primary_key is None:
+            cls.__row_cache__.clear()
+        else:
+            cls.__row_cache__.invalidate(cls.cache_key(primary_key))
+
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, instances, batch_size=1000):
+        """
+        Insert objects with multi-row INSERT statements
+
+        Every batch is a single statement, so it is committed (or rejected) as one transaction.
+
+        :param instances: objects of this model
+        :param batch_size: max number of rows per INSERT statement
+        :return: a list of row affected, one per batch
+        """
+        instances = list(instances)
+        row_affected_list = []
+        for start in range(0, len(instances), batch_size):
+            batch = instances[start:start + batch_size]
+            args = []
+            for instance in batch:
+                args.extend(instance.insert_args())
+            sql = cls.__insert_many__ + ', '.join([cls.__insert_row__] * len(batch))
+            row_affected = yield from execute(sql, args)
+            _row_counter.adjust(cls.__table__, row_affected)
+            for instance in batch:
+                cls.invalidate_cache(instance[cls.__primary_key__])
+            if row_affected != len(batch):
+                logging.warning('Failed to save %s records, row affected: %s' % (len(batch), row_affected))
+            row_affected_list.append(row_affected)
+        return row_affected_list
 
     @asyncio.coroutine
-    def save(self):
+    def load_deferred(self, *field_names):
+        """
+        Load deferred fields (all of them by default) of an object found with columns/defer
+
+        e.g.  yield from blog.load_deferred('content')
+        """
+        field_names = [f for f in (field_names or self.__fields__) if f in self.__deferred__]
+        if not field_names:
+            return
+        sql = 'SELECT %s from `%s` WHERE `%s`=?' % \
+              (', '.join(select_column(f, self.__mappings__[f]) for f in field_names), self.__table__,
+               self.__primary_key__)
+        result = yield from select(sql, [self[self.__primary_key__]], 1)
+        if not result:
+            raise ValueError('[ORM]: %s does not exist any more' % self[self.__primary_key__])
+        self.update(result[0])
+        self.convert_from_db(self)
+        object.__setattr__(self, '__deferred__', self.__deferred__.difference(field_names))
+
+    def insert_args(self):
+        if self.__deferred__:
+            raise ValueError('[ORM]: Can not save an object with deferred fields: %s' % ', '.join(self.__deferred__))
+        # 与__insert__的参数顺序一致 主键在最前
         args = [self.get_value_or_default(self.__primary_key__)]
-        args.extend(list(map(self.get_value_or_default, self.__fields__)))
-        row_affected = yield from execute(self.__insert__, args)
+        args.extend(list(map(self.db_value, self.__fields__)))
+        args.extend(list(map(self.shadow_value, self.__shadows__)))
+        return args
+
+    @asyncio.coroutine
+    def save(self, deferred=False):
+        """
+        Insert the object
+
+        :param deferred: put the row into the write-behind buffer and return at once, the returned future
+                         is resolved when the row is committed (e.g. yield from comment.save(deferred=True)).
+                         Inside a transaction the row is always inserted at once.
+        """
+        if deferred:
+            if not in_transaction():
+                return _write_buffer.add(self)
+            future = asyncio.get_event_loop().create_future()
+            yield from self.save()
+            future.set_result(True)
+            return future
+        row_affected = yield from execute(self.__insert__, self.insert_args())
+        _row_counter.adjust(self.__table__, row_affected)
+        self.invalidate_cache(self[self.__primary_key__])
+        self.mark_clean()
         if row_affected != 1:
             logging.warning('Failed to save record, row affected: %s' % row_affected)
 
+    @asyncio.coroutine
+    def upsert(self, update_fields=None, increment_fields=None):
+        """
+        INSERT ... ON DUPLICATE KEY UPDATE in one statement
+
+        e.g.  yield from counter.upsert(increment_fields=['hits'])  # insert, or add hits to the existing row
+
+        :param update_fields: fields overwritten with the new values when the row exists, default all but primary key
+        :param increment_fields: fields increased by the new values when the row exists
+        :return: 'inserted', 'updated' or 'unchanged'
+        """
+        increment_fields = list(increment_fields or [])
+        if update_fields is None:
+            update_fields = [f for f in self.__fields__ if f not in increment_fields]
+        for field_name in list(update_fields) + increment_fields:
+            if field_name not in self.__mappings__:
+                raise ValueError('[ORM]: The model don\'t have %s field' % field_name)
+        assignments = ['`%s`=VALUES(`%s`)' % (f, f) for f in update_fields]
+        assignments.extend('`%s`=VALUES(`%s`)' % (self.__shadows__[f], self.__shadows__[f])
+                           for f in update_fields if f in self.__shadows__)
+        assignments.extend('`%s`=`%s`+VALUES(`%s`)' % (f, f, f) for f in increment_fields)
+        if not assignments:
+            # 什么都不更新 等同于INSERT IGNORE但不会忽略其他错误
+            assignments = ['`%s`=`%s`' % (self.__primary_key__, self.__primary_key__)]
+        sql = '%s ON DUPLICATE KEY UPDATE %s' % (self.__insert__, ', '.join(assignments))
+        row_affected = yield from execute(sql, self.insert_args())
+        # MySQL: 1 插入, 2 更新, 0 已存在且值没变
+        if row_affected == 1:
+            _row_counter.adjust(self.__table__, 1)
+        self.invalidate_cache(self[self.__primary_key__])
+        return {0: 'unchanged', 1: 'inserted'}.get(row_affected, 'updated')
+
+    @classmethod
+    @asyncio.coroutine
+    def delete_many(cls, primary_keys, chunk_size=1000):
+        """
+        Delete rows by a list of primary keys with chunked DELETE ... WHERE pk IN (...) statements
+
+        :return: total row affected
+        """
+        primary_keys = list(primary_keys)
+        total = 0
+        for start in range(0, len(primary_keys), chunk_size):
+            chunk = primary_keys[start:start + chunk_size]
+            sql = 'DELETE FROM `%s` WHERE `%s` IN (%s)' % \
+                  (cls.__table__, cls.__primary_key__, create_args_string(len(chunk)))
+            row_affected = yield from execute(sql, chunk)
+            _row_counter.adjust(cls.__table__, -row_affected)
+            total += row_affected
+            for primary_key in chunk:
+                cls.invalidate_cache(primary_key)
+        return total
+
+    @classmethod
+    @asyncio.coroutine
+    def update_where(cls, values, where, args=None):
+        """
+        Update every row matched by where clause in one statement
+
+        e.g. Blog.update_where(dict(user_avatar=avatar), 'user_id=?', [uid])
+
+        :param values: dict of field name => new value
+        :return: row affected
+        """
+        if not values:
+            raise ValueError('[ORM]: Nothing to update')
+        if not where:
+            # 防止一不小心更新了整张表
+            raise ValueError('[ORM]: update_where needs a where clause')
+        for field_name in values:
+            if field_name not in cls.__mappings__:
+                raise ValueError('[ORM]: The model don\'t have %s field' % field_name)
+        names = list(values)
+        columns = names + [cls.__shadows__[name] for name in names if name in cls.__shadows__]
+        sql = 'UPDATE `%s` SET %s WHERE %s' % \
+              (cls.__table__, ', '.join(map(lambda f: '`%s`=?' % f, columns)), where)
+        sql_args = [cls.__converted__[name].to_db(values[name])
+                    if name in cls.__converted__ and values[name] is not None else values[name] for name in names]
+        for idx, name in enumerate(names):
+            if name in cls.__shadows__:
+                # 原来的列写文本 压缩后的写进shadow列
+                sql_args.append(sql_args[idx])
+                sql_args[idx] = None if values[name] is None else str(values[name])
+        sql_args.extend(args or [])
+        row_affected = yield from execute(sql, sql_args)
+        # 不知道更新了哪些行 整个清掉
+        cls.invalidate_cache()
+        return row_affected
+
     @asyncio.coroutine
     def update_data(self):
-        # ... update 的 sql 主键在最后 ，insert , select 我都把主键放在最后了。。。 还是廖老师技高一筹啊
-        # UPDATE `users` SET `admin`=?, `created_at`=?, `password`=?, `name`=?, `avatar`=?, `email`=? WHERE `id`=?
-        args = list(map(self.get_value_or_default, self.__fields__))
-        args.append(self.get_value_or_default(self.__primary_key__))
-        row_affected = yield from execute(self.__update__, args)
+        """
+        Write the changed fields: UPDATE ... SET <changed fields> WHERE pk=?
+
+        An object loaded from the database only writes the fields set after loading and does nothing if
+        none was. An object built by hand writes the fields it has, so Blog(id=blog_id, name=name).update_data()
+        updates a row without selecting it first.
+        With a VersionField the update is conditional on the version and raises StaleDataError if it does not match.
+
+        :return: row affected
+        """
+        version_field = self.__version_field__
+        fields = [f for f in self.changed_fields() if f != version_field]
+        if not fields:
+            return 0
+        primary_key = self.get_value_or_default(self.__primary_key__)
+        # e.g UPDATE `blogs` SET `name`=?, `summary`=? WHERE `id`=?
+        shadows = [f for f in fields if f in self.__shadows__]
+        sql = 'UPDATE `%s` SET %s' % (self.__table__, ', '.join(
+            map(lambda f: '`%s`=?' % f, fields + [self.__shadows__[f] for f in shadows])))
+        args = list(map(self.db_value, fields))
+        args.extend(list(map(self.shadow_value, shadows)))
+        if version_field:
+            sql += ', `%s`=`%s`+1' % (version_field, version_field)
+        sql += ' WHERE `%s`=?' % self.__primary_key__
+        args.append(primary_key)
+        version = self.get(version_field) if version_field else None
+        if version is not None:
+            sql += ' AND `%s`=?' % version_field
+            args.append(version)
+        row_affected = yield from execute(sql, args)
+        self.invalidate_cache(primary_key)
         if row_affected != 1:
+            if version is not None:
+                raise StaleDataError('[ORM]: %s %s was changed or deleted' % (self.__table__, primary_key))
             logging.warning('Failed to update, row affected: %s' % row_affected)
+            return row_affected
+        if version is not None:
+            super(Model, self).__setitem__(version_field, version + 1)
+        if self.__dirty__ is not None:
+            self.mark_clean()
+        return row_affected
 
     @asyncio.coroutine
     def delete(self):
         args = [self.get_value_or_default(self.__primary_key__)]
         row_affected = yield from execute(self.__delete__, args)
+        _row_counter.adjust(self.__table__, -row_affected)
+        self.invalidate_cache(args[0])
         if row_affected != 1:
             logging.warning('Failed to delete, row affected: %s' % row_affected)
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+import orm
+from model import Comment
+
+logging.basicConfig(level=logging.WARNING)
+
+
+async def test(loop):
+    await orm.create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+
+    # 主键按MySQL的规则比较: 整数列'1' = 1 字符串列不区分大小写 忽略结尾的空格
+    loader = orm.BatchLoader('SELECT `id` from `bench`', 'id', 'bigint')
+    assert loader.match_key('1') == loader.match_key(1) == 1
+    loader = orm.BatchLoader('SELECT `id` from `bench`', 'id', 'varchar(50)')
+    assert loader.match_key('AbC  ') == loader.match_key('abc') == 'abc'
+
+    comments = await Comment.find_all(limit=5, columns=['blog_id'])
+    if comments:
+        ids = [c.id for c in comments]
+        stats = Comment.__batch_loader__.stats()
+
+        # 同一个tick里的查询合并成一个IN查询 重复的主键只查一次
+        with orm.track_queries() as queries:
+            found = await asyncio.gather(*[Comment.find_by_primary_key(i) for i in ids + ids])
+        assert [c.id for c in found] == ids + ids, found
+        assert queries.total == 1, queries.most_common()
+        after = Comment.__batch_loader__.stats()
+        assert after['batches'] == stats['batches'] + 1 and after['keys'] == stats['keys'] + len(ids), after
+
+        # 大小写和结尾空格不同的主键也能拿到行
+        variants = [ids[0].upper(), ids[0] + ' ', 'no such id']
+        found = await asyncio.gather(*[Comment.find_by_primary_key(i) for i in variants])
+        assert [c.id if c else None for c in found] == [ids[0], ids[0], None], found
+
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
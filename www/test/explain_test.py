@@ -0,0 +1,36 @@
+import asyncio
+import logging
+
+import orm
+from model import User, Blog, Comment
+
+logging.basicConfig(level=logging.WARNING)
+
+
+async def test(event_loop):
+    await orm.create_db_pool(user='blog-data', password=' ', db='blog', loop=event_loop)
+    # 行数估计超过100还全表扫描或filesort的查询都算问题
+    checker = orm.enable_plan_checker(max_rows=100)
+
+    # handlers里用到的查询
+    blogs = await Blog.find_all(limit=8, order_by='created_at DESC', defer=['content'])
+    await Blog.find_all(order_by='created_at DESC', limit=(0, 10), defer=['content'])
+    if blogs:
+        await Blog.find_all(after=(blogs[-1].created_at, blogs[-1].id), limit=11, defer=['content'])
+        await Blog.find_by_primary_key(blogs[0].id)
+        await Comment.find_all(where='blog_id=?', args=[blogs[0].id], order_by='created_at DESC',
+                               select_related=['user'])
+    await User.find_all(where='email=?', args=['test@org.com'])
+
+    for problem in checker.problems:
+        print(problem)
+    assert not checker.problems, '%s slow query plans' % len(checker.problems)
+
+    orm.disable_plan_checker()
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
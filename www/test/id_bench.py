@@ -0,0 +1,83 @@
+import time
+import uuid
+import asyncio
+import logging
+
+import orm
+from orm import Model, StringField, FloatField, IdField, create_table_sql
+from model import create_id
+
+logging.basicConfig(level=logging.WARNING)
+
+# 建表要CREATE/DROP权限 blog-data没有 用root跑
+USER, PASSWORD = 'root', ''
+ROWS = 100000
+BATCH = 1000
+
+
+def uuid_id():
+    # 原来的create_id
+    return '%15d%s000' % (time.time(), uuid.uuid4().hex)
+
+
+class UuidKey(Model):
+    __table__ = 'bench_uuid_key'
+
+    id = StringField(column_type='varchar(50)', primary_key=True, default=uuid_id)
+    user_id = StringField(column_type='varchar(50)', index=True)
+    created_at = FloatField(default=time.time, index=True)
+
+
+class SortableKey(Model):
+    __table__ = 'bench_sortable_key'
+
+    id = StringField(column_type='varchar(50)', primary_key=True, default=create_id)
+    user_id = StringField(column_type='varchar(50)', index=True)
+    created_at = FloatField(default=time.time, index=True)
+
+
+class BigintKey(Model):
+    __table__ = 'bench_bigint_key'
+
+    id = IdField(primary_key=True)
+    user_id = StringField(column_type='varchar(50)', index=True)
+    created_at = FloatField(default=time.time, index=True)
+
+
+async def bench_model(model):
+    await orm.execute('DROP TABLE IF EXISTS `%s`' % model.__table__)
+    await orm.execute(create_table_sql(model))
+
+    start = time.perf_counter()
+    for _ in range(0, ROWS, BATCH):
+        await model.save_many([model(user_id='user%s' % (i % 100)) for i in range(BATCH)], batch_size=BATCH)
+    cost = time.perf_counter() - start
+
+    # 更新统计信息后再读大小
+    await orm.select('ANALYZE TABLE `%s`' % model.__table__)
+    rows = await orm.select('SELECT DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES '
+                            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?', [model.__table__], 1)
+    print('%-20s %s rows in %.3fs (%.0f rows/s), clustered index %.1f MB, secondary indexes %.1f MB' %
+          (model.__table__, ROWS, cost, ROWS / cost,
+           rows[0]['DATA_LENGTH'] / 1024 / 1024, rows[0]['INDEX_LENGTH'] / 1024 / 1024))
+    await orm.execute('DROP TABLE `%s`' % model.__table__)
+
+
+async def bench(loop):
+    await orm.create_db_pool(loop=loop, user=USER, password=PASSWORD, db='blog')
+
+    # 同一进程内的id必须单调递增 编码后的字符串顺序也一样
+    ids = [orm.next_id() for _ in range(ROWS)]
+    assert ids == sorted(ids) and len(set(ids)) == ROWS
+    encoded = [orm.encode_id(i) for i in ids]
+    assert encoded == sorted(encoded) and [orm.decode_id(s) for s in encoded] == ids
+    assert '-' not in ''.join(encoded)  # cookie用'-'分隔
+
+    for model in (UuidKey, SortableKey, BigintKey):
+        await bench_model(model)
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop))
+    loop.close()
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+
+import orm
+import handlers
+from model import User, Blog, Comment
+
+logging.basicConfig(level=logging.WARNING)
+
+
+class FakeRequest(object):
+    __user__ = None
+    __admin__ = False
+
+
+async def test(event_loop):
+    await orm.create_db_pool(user='blog-data', password=' ', db='blog', loop=event_loop)
+
+    # 每个页面的查询次数上限 缓存命中不算
+    with orm.query_budget(1):
+        await handlers.index(FakeRequest())
+    with orm.query_budget(2):
+        await handlers.archive(FakeRequest())
+    blogs = await Blog.find_all(limit=1, defer=['content'])
+    if blogs:
+        # blog + comments + 评论者(一个IN查询)
+        with orm.query_budget(3, max_per_shape=1):
+            await handlers.read_blog(blogs[0].id, FakeRequest())
+
+    # 循环里逐个查询 会被记成同一种语句
+    comments = await Comment.find_all(limit=20)
+    with orm.track_queries(n_plus_one=5) as stats:
+        for c in comments:
+            await User.find_all(where='id=?', args=[c.user_id], query_cache=False)
+    assert stats.total == len(comments) and len(stats.shapes) <= 1, stats.shapes
+    try:
+        with orm.query_budget(5):
+            for c in comments:
+                await User.find_all(where='id=?', args=[c.user_id], query_cache=False)
+    except AssertionError as e:
+        assert len(comments) > 5, e
+    else:
+        assert len(comments) <= 5
+
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
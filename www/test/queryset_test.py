@@ -0,0 +1,36 @@
+import asyncio
+import logging
+
+import orm
+from model import Blog
+
+logging.basicConfig(level=logging.WARNING)
+
+
+@asyncio.coroutine
+def latest_blogs():
+    # 文档里的写法: 在@asyncio.coroutine里yield from一个QuerySet
+    blogs = yield from Blog.query().order_by('created_at desc').defer('content')[0:10]
+    return blogs
+
+
+async def test(loop):
+    await orm.create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+
+    blogs = await latest_blogs()
+    assert isinstance(blogs, list) and len(blogs) <= 10, blogs
+    expected = await Blog.find_all(order_by='created_at desc', limit=10, defer=['content'])
+    assert [b.id for b in blogs] == [b.id for b in expected]
+
+    # await和async for的结果一样
+    awaited = await Blog.query().order_by('created_at desc').defer('content')[0:10]
+    iterated = [b async for b in Blog.query().order_by('created_at desc').defer('content')[0:10]]
+    assert [b.id for b in awaited] == [b.id for b in iterated] == [b.id for b in blogs]
+
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
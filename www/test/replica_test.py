@@ -0,0 +1,59 @@
+import time
+import asyncio
+import logging
+
+import orm
+from model import User
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def test(event_loop):
+    # 本地的同一个库充当两个副本
+    await orm.create_db_pool(
+        user='blog-data', password=' ', db='blog', loop=event_loop,
+        replicas=[dict(name='replica_a', weight=2), dict(name='replica_b', db='blog')],
+        read_your_writes=2
+    )
+
+    # 加权轮询: a被选中的次数是b的两倍
+    names = [orm.read_pool()[0] for _ in range(6)]
+    assert names.count('replica_a') == 4 and names.count('replica_b') == 2, names
+
+    async def request():
+        user = User(name='replica', email='replica@test.com', password='replica', avatar='about:blank')
+        await user.save()
+        # 写过之后 这个请求的读操作走主库
+        assert orm.read_pool()[0] is None
+        assert (await User.find_by_primary_key(user.id)) is not None
+        await user.delete()
+    await event_loop.create_task(request())
+    # 其他请求不受影响
+    assert orm.read_pool()[0] is not None
+
+    # 副本读到的行只在缓存里放replica_cache_ttl(默认read_your_writes)秒
+    user = User(name='replica', email='replica2@test.com', password='replica', avatar='about:blank')
+    await event_loop.create_task(user.save())
+    assert (await User.find_by_primary_key(user.id)) is not None
+    expire, row = User.__row_cache__._rows[user.id]
+    assert expire - time.time() <= 2, expire - time.time()
+
+    async def edit():
+        # 缓存里是旧行 写过数据的请求要读到自己写的
+        await User.update_where(dict(name='edited'), 'id=?', [user.id])
+        User.__row_cache__._rows[user.id] = (time.time() + 60, row)
+        assert (await User.find_by_primary_key(user.id)).name == 'edited'
+        await user.delete()
+    await event_loop.create_task(edit())
+
+    orm._replicas.eject('replica_a')
+    assert {orm.read_pool()[0] for _ in range(3)} == {'replica_b'}
+    assert await orm._replicas.check('replica_a')
+
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
@@ -0,0 +1,39 @@
+import time
+import tracemalloc
+
+from model import Blog
+
+ROWS = 10000
+
+
+def fake_rows():
+    columns = [Blog.__primary_key__] + Blog.__fields__
+    tuples = []
+    for idx in range(ROWS):
+        values = dict(id='%050d' % idx, user_id='u' * 50, user_name='name%s' % idx, user_avatar='about:blank',
+                      name='blog%s' % idx, summary='summary %s' % idx, content='content %s' % idx,
+                      created_at=1500000000.0 + idx, version=0)
+        tuples.append(tuple(values[c] for c in columns))
+    dicts = [dict(zip(columns, t)) for t in tuples]
+    return tuples, dicts
+
+
+def measure(name, build, source):
+    start = time.perf_counter()
+    build(source)
+    cost = time.perf_counter() - start
+    tracemalloc.start()
+    objects = build(source)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    print('%-22s %.1f ms / %s rows, %d bytes per row' % (name, cost * 1000, ROWS, size / ROWS))
+
+
+if __name__ == '__main__':
+    tuples, dicts = fake_rows()
+    # DictCursor的行 -> Model, 和find_all一样
+    measure('Model from dict rows', lambda rows: [Blog.from_row(r) for r in rows], dicts)
+    # 普通cursor的tuple -> Row, find_all(as_rows=True)
+    row_class = Blog.row_class()
+    measure('Row from tuple rows', lambda rows: [row_class(*r) for r in rows], tuples)
@@ -0,0 +1,49 @@
+import time
+import asyncio
+import logging
+
+from orm import create_db_pool, destroy_pool
+from model import User
+
+logging.basicConfig(level=logging.WARNING)
+
+ROWS = 2000
+
+
+def make_users(prefix):
+    return [User(
+        name='bench%s' % idx,
+        email='%s%s@bench.com' % (prefix, idx),
+        password='bench%s' % idx,
+        avatar='about:blank'
+    ) for idx in range(ROWS)]
+
+
+async def bench(loop):
+    await create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+
+    # 逐行save
+    users = make_users('row')
+    start = time.perf_counter()
+    for u in users:
+        await u.save()
+    row_cost = time.perf_counter() - start
+    print('save() loop:  %s rows in %.3fs (%.0f rows/s)' % (ROWS, row_cost, ROWS / row_cost))
+
+    # 多行INSERT
+    users = make_users('many')
+    start = time.perf_counter()
+    counts = await User.save_many(users, batch_size=1000)
+    many_cost = time.perf_counter() - start
+    print('save_many():  %s rows in %.3fs (%.0f rows/s), batches: %s' % (ROWS, many_cost, ROWS / many_cost, counts))
+    print('speed up: %.1fx' % (row_cost / many_cost))
+
+    # 清理测试数据
+    for u in await User.find_all(where='email like ?', args=['%@bench.com']):
+        await u.delete()
+    await destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop))
+    loop.close()
@@ -0,0 +1,41 @@
+import time
+import asyncio
+import logging
+
+import orm
+from model import User
+
+logging.basicConfig(level=logging.WARNING)
+
+ROWS = 500
+
+
+async def bench(loop):
+    await orm.create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+    users = [User(name='tx%s' % idx, email='tx%s@bench.com' % idx, password='tx', avatar='about:blank')
+             for idx in range(ROWS)]
+
+    # 每条语句一次连接 一次提交
+    start = time.perf_counter()
+    for u in users:
+        await u.save()
+    autocommit_cost = time.perf_counter() - start
+    await User.delete_many([u.id for u in users])
+
+    # 一个连接 一次提交
+    start = time.perf_counter()
+    async with orm.transaction():
+        for u in users:
+            await u.save()
+    transaction_cost = time.perf_counter() - start
+    await User.delete_many([u.id for u in users])
+
+    print('autocommit:  %s inserts in %.3fs' % (ROWS, autocommit_cost))
+    print('transaction: %s inserts in %.3fs' % (ROWS, transaction_cost))
+    print('speed up: %.1fx' % (autocommit_cost / transaction_cost))
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop))
+    loop.close()
@@ -0,0 +1,40 @@
+import asyncio
+import logging
+
+import orm
+from model import Blog
+
+logging.basicConfig(level=logging.WARNING)
+
+
+async def test(loop):
+    await orm.create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+    blogs = await Blog.find_all(limit=3, defer=['content'])
+
+    # 迭代没结束时同一个事务里再执行语句 要马上报错 不能一直等锁
+    if blogs:
+        try:
+            async with orm.transaction():
+                async for blog in Blog.iter_all(chunk_size=2, defer=['content']):
+                    await asyncio.wait_for(Blog.find_all(where='id=?', args=[blog.id], query_cache=False), 5)
+        except RuntimeError as e:
+            assert 'select_iter' in str(e), e
+        else:
+            assert False, 'expect RuntimeError'
+
+    # 迭代完之后连接可以继续用
+    async with orm.transaction():
+        ids = []
+        async for blog in Blog.iter_all(chunk_size=2, defer=['content']):
+            ids.append(blog.id)
+        for blog_id in ids[:3]:
+            rows = await asyncio.wait_for(Blog.find_all(where='id=?', args=[blog_id], query_cache=False), 5)
+            assert len(rows) == 1, rows
+
+    await orm.destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(test(loop))
+    print("Test pass")
+    loop.close()
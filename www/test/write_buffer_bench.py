@@ -0,0 +1,57 @@
+import time
+import asyncio
+import logging
+
+from orm import create_db_pool, destroy_pool, write_buffer_stats
+from model import Comment
+
+logging.basicConfig(level=logging.WARNING)
+
+ROWS = 2000
+
+
+def make_comments(prefix):
+    return [Comment(
+        blog_id='bench',
+        user_id='bench',
+        user_name='bench',
+        user_avatar='about:blank',
+        content='%s%s' % (prefix, idx)
+    ) for idx in range(ROWS)]
+
+
+async def bench(loop):
+    await create_db_pool(loop=loop, user='blog-data', password=' ', db='blog', maxsize=10)
+
+    # 一阵并发的小写入 每行一个事务
+    comments = make_comments('row')
+    start = time.perf_counter()
+    await asyncio.gather(*[c.save() for c in comments])
+    row_cost = time.perf_counter() - start
+    print('save():               %s rows in %.3fs (%.0f rows/s)' % (ROWS, row_cost, ROWS / row_cost))
+
+    # 同样的写入走write-behind缓冲区 等到每一行都提交
+    comments = make_comments('deferred')
+    start = time.perf_counter()
+    futures = [await c.save(deferred=True) for c in comments]
+    await asyncio.gather(*futures)
+    buffer_cost = time.perf_counter() - start
+    print('save(deferred=True):  %s rows in %.3fs (%.0f rows/s), %s' %
+          (ROWS, buffer_cost, ROWS / buffer_cost, write_buffer_stats()))
+    print('speed up: %.1fx' % (row_cost / buffer_cost))
+
+    # 关闭时缓冲区里的行也要写进去
+    comment = make_comments('drain')[0]
+    future = await comment.save(deferred=True)
+    await destroy_pool()
+    assert future.done() and future.result() is True
+
+    await create_db_pool(loop=loop, user='blog-data', password=' ', db='blog')
+    comments = await Comment.find_all(where='blog_id=?', args=['bench'], columns=['blog_id'])
+    await Comment.delete_many([c.id for c in comments])
+    await destroy_pool()
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(bench(loop))
+    loop.close()